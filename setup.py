@@ -21,6 +21,7 @@ setup(
     package_data={'': ['model.tflite']},
     install_requires=[
         'requests',
+        'urllib3>=1.26',
         'Pillow',
         'ansicolors',
         'colorama>=0.4.6',
@@ -33,7 +34,10 @@ setup(
         "auto-captcha": [
             "tflite-runtime;python_version < '3.10'",
             "tensorflow;python_version >= '3.10'",
-        ]
+        ],
+        "asyncio": [
+            "aiohttp",
+        ],
     },
     python_requires='>=3.7',
     packages=setuptools.find_packages(),
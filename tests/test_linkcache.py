@@ -0,0 +1,49 @@
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from contextlib import closing
+
+from uldlib import linkcache
+from uldlib.const import LINKCACHE_DB
+from uldlib.linkcache import LinkCache
+
+
+class LinkCacheCompactionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.tmp.name, LINKCACHE_DB)
+
+    def tearDown(self):
+        linkcache._prepared.discard(self.db_file)
+        self.tmp.cleanup()
+
+    def _pragma(self, name: str) -> int:
+        with closing(sqlite3.connect(self.db_file)) as db:
+            return db.execute(f"PRAGMA {name}").fetchone()[0]
+
+    def test_expired_links_are_pruned_and_space_freed(self):
+        tm = int(time.time()) + 3600
+        cache = LinkCache(self.tmp.name, "slug")
+        cache._add_links([f"https://example.com/file?i={i}{'x' * 200};tm={tm}" for i in range(2000)])
+        LinkCache(self.tmp.name, "other").add(f"https://example.com/other;tm={tm}")
+
+        # links of the first file expire
+        with closing(sqlite3.connect(self.db_file)) as db, db:
+            db.execute("UPDATE links SET tm = 1 WHERE slug = 'slug'")
+        pages = self._pragma("page_count")
+
+        # database is compacted when opened by the next process
+        linkcache._prepared.discard(self.db_file)
+        cache = LinkCache(self.tmp.name, "slug")
+
+        self.assertEqual(self._pragma("freelist_count"), 0)
+        self.assertLess(self._pragma("page_count"), pages)
+        self.assertEqual(cache.get_all_valid_links(), [])
+        self.assertEqual(len(LinkCache(self.tmp.name, "other").get_all_valid_links()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
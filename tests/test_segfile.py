@@ -0,0 +1,261 @@
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+from io import BytesIO
+from sys import byteorder
+
+from uldlib.segfile import RANGES_MARK, RECORD_SIZE, WRITE_MODE_FILE, WRITE_MODES, PipeSink, SegFileLoader, SegFileWriter, \
+    _HEADER, _header_size, _pack_header, _pack_record, _unpack_header, _unpack_record
+
+SIZE = 1000
+SLUG = "slug"
+
+
+class SegFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.tmp.name, "file.bin")
+        self.stat_file = self.file + ".udown"
+        self.logs = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _loader(self, parts: int = 4, slug: str = SLUG, mode: str = WRITE_MODE_FILE) -> SegFileLoader:
+        return SegFileLoader(self.file, self.stat_file, SIZE, parts, mode=mode, slug=slug, log_func=self.logs.append)
+
+    def _segments(self):
+        """Returns (slug, size, records) recorded in the stat file"""
+        with open(self.stat_file, 'rb') as sfp:
+            data = sfp.read()
+        (slug, size, segments) = _unpack_header(data)
+        pos = _header_size(len(slug))
+        return (slug, size, [_unpack_record(data[pos + i * RECORD_SIZE:pos + (i + 1) * RECORD_SIZE])
+                             for i in range(segments)])
+
+
+class StatFileTest(SegFileTestCase):
+
+    def _download(self, written: int):
+        """Writes given number of bytes (the segment number + 1) at the start of each segment"""
+        loader = self._loader()
+        for w in loader.make_writers():
+            w.write(bytes([w.id + 1]) * written)
+            w.close()
+        loader.close()
+
+    def _write_stat(self, data: bytes):
+        with open(self.stat_file, 'wb') as sfp:
+            sfp.write(data)
+        with open(self.file, 'wb') as fp:
+            fp.truncate(SIZE)
+
+    def _resumed(self, slug: str = SLUG):
+        """Returns sorted (from, to, written) of segments of the resumed download"""
+        loader = self._loader(slug=slug)
+        writers = loader.make_writers()
+        for w in writers:
+            w.close()
+        loader.close()
+        return sorted((w.pfrom, w.pto, w.written) for w in writers)
+
+    def test_round_trip(self):
+        self._download(100)
+        self.assertEqual(self._segments(), (SLUG.encode(), SIZE, [
+            (0, 249, 100), (250, 499, 100), (500, 749, 100), (750, 999, 100)]))
+
+        self.assertEqual(self._resumed(), [(0, 249, 100), (250, 499, 100), (500, 749, 100), (750, 999, 100)])
+        self.assertEqual(self.logs, [])
+        with open(self.file, 'rb') as fp:
+            data = fp.read()
+        self.assertEqual(data[250:350], b"\x02" * 100)
+        self.assertEqual(data[350:500], bytes(150))
+
+    def test_v1_legacy_migration(self):
+        sbs = 8
+        positions = [100, 250 + 50, 500, 750 + 250]
+        self._write_stat(bytes([sbs]) + SIZE.to_bytes(sbs, byteorder)
+                         + b"".join(p.to_bytes(sbs, byteorder) for p in positions))
+
+        self.assertEqual(self._resumed(), [(0, 249, 100), (250, 499, 50), (500, 749, 0), (750, 999, 250)])
+        self.assertIn("Migrating .udown file to the format v2", self.logs)
+        self.assertEqual(self._segments()[0], SLUG.encode())
+
+    def test_v1_ranges_migration(self):
+        sbs = 8
+        ranges = [(0, 599, 10), (600, 999, 700)]
+        self._write_stat(bytes([RANGES_MARK, sbs]) + SIZE.to_bytes(sbs, byteorder) + len(ranges).to_bytes(sbs, byteorder)
+                         + b"".join(v.to_bytes(sbs, byteorder) for r in ranges for v in r))
+
+        self.assertEqual(self._resumed(), [(0, 599, 10), (600, 999, 100)])
+        self.assertEqual(self._segments()[2], [(0, 599, 10), (600, 999, 100)])
+
+    def test_corrupted_header_recovers_records(self):
+        self._download(100)
+        with open(self.stat_file, 'rb+') as sfp:
+            sfp.seek(_HEADER.size - 1)
+            sfp.write(b"\xff")  # the number of segments
+
+        self.assertEqual(self._resumed(), [(0, 249, 100), (250, 499, 100), (500, 749, 100), (750, 999, 100)])
+        self.assertIn("WARNING: Corrupted header of .udown file, trying to recover segments", self.logs)
+        self.assertEqual(len(self._segments()[2]), 4)
+
+    def test_corrupted_record_is_downloaded_again(self):
+        self._download(100)
+        with open(self.stat_file, 'rb+') as sfp:
+            sfp.seek(_header_size(len(SLUG)) + RECORD_SIZE + 16)
+            sfp.write(b"\xff")  # written of the segment 1
+
+        self.assertEqual(self._resumed(), [(0, 249, 100), (250, 499, 0), (500, 749, 100), (750, 999, 100)])
+        self.assertIn("WARNING: 1 corrupted segment(s) in .udown file, they will be downloaded again", self.logs)
+
+    def test_other_slug_starts_fresh_download(self):
+        self._download(100)
+
+        self.assertEqual(self._resumed(slug="other"), [(0, 249, 0), (250, 499, 0), (500, 749, 0), (750, 999, 0)])
+        self.assertEqual(self._segments()[0], b"other")
+
+    def test_unsupported_version(self):
+        header = bytearray(_pack_header(SLUG.encode(), SIZE, 0))
+        header[4] = 3
+        self._write_stat(bytes(header) + _pack_record(0, SIZE - 1, 0))
+
+        with self.assertRaises(ValueError):
+            self._resumed()
+
+
+class SplitTest(SegFileTestCase):
+    """Work stealing: the rest of a running segment becomes a new segment"""
+
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(SIZE)
+
+    def _write(self, writer: SegFileWriter, size: int) -> int:
+        return writer.write(self.data[writer.cur_pos:writer.cur_pos + size])
+
+    def _check_split_and_resume(self, mode: str):
+        loader = self._loader(parts=2, mode=mode)
+        (first, second) = loader.make_writers()
+        self._write(first, 100)
+        new = loader.split(first, min_size=50)
+        self.assertEqual((first.pto, new.pfrom, new.pto), (299, 300, 499))
+        # data behind the shortened end are thrown away
+        self.assertEqual(self._write(first, 300), 200)
+        self._write(new, 60)
+        self._write(second, 10)
+        for w in (first, second, new):
+            w.close()
+        loader.close()
+        self.assertEqual(self._segments()[2], [(0, 299, 300), (500, 999, 10), (300, 499, 60)])
+
+        loader = self._loader(parts=2, mode=mode)
+        writers = loader.make_writers()
+        self.assertEqual([(w.pfrom, w.pto, w.written) for w in writers], [(0, 299, 300), (500, 999, 10), (300, 499, 60)])
+        for w in writers:
+            while w.remaining():
+                self._write(w, 64)
+            w.close()
+        loader.close()
+
+        self.assertEqual(self._segments()[2], [(0, 299, 300), (500, 999, 500), (300, 499, 200)])
+        with open(self.file, 'rb') as fp:
+            self.assertEqual(fp.read(), self.data)
+
+    def test_split_and_resume(self):
+        for mode in WRITE_MODES:
+            with self.subTest(mode=mode):
+                self._check_split_and_resume(mode)
+                os.remove(self.file)
+                os.remove(self.stat_file)
+
+    def test_split_running_writer(self):
+        for mode in WRITE_MODES:
+            with self.subTest(mode=mode):
+                loader = self._loader(parts=1, mode=mode)
+                (writer,) = loader.make_writers()
+                self._write(writer, 10)
+
+                started = threading.Event()
+
+                def download():
+                    while writer.remaining():
+                        self._write(writer, 7)
+                        started.set()
+                        time.sleep(0.001)
+
+                thread = threading.Thread(target=download)
+                thread.start()
+                started.wait()
+                new = loader.split(writer, min_size=100)
+                thread.join()
+                while new.remaining():
+                    self._write(new, 7)
+                writer.close()
+                new.close()
+                loader.close()
+
+                self.assertEqual(self._segments()[2], [(0, new.pfrom - 1, new.pfrom), (new.pfrom, SIZE - 1, SIZE - new.pfrom)])
+                with open(self.file, 'rb') as fp:
+                    self.assertEqual(fp.read(), self.data)
+                os.remove(self.file)
+                os.remove(self.stat_file)
+
+
+class PipeSinkTest(unittest.TestCase):
+    """Chunks written out of order by concurrent writers are emitted in the stream order"""
+
+    def _writer(self, sink: PipeSink, pos: int, data: bytes, errors: list) -> threading.Thread:
+        def write():
+            try:
+                sink.write(pos, data)
+            except EOFError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        return thread
+
+    def test_out_of_order_writes(self):
+        data = os.urandom(1000)
+        out = BytesIO()
+        sink = PipeSink(out, max_buffer=300)
+        chunks = list(range(0, len(data), 50))
+        random.Random(1).shuffle(chunks)
+
+        errors = []
+        threads = [self._writer(sink, pos, data[pos:pos + 50], errors) for pos in chunks]
+        for thread in threads:
+            thread.join(5)
+        sink.close()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(out.getvalue(), data)
+        self.assertEqual(sink.buffered, 0)
+
+    def test_interrupt_wakes_blocked_writers(self):
+        out = BytesIO()
+        sink = PipeSink(out, max_buffer=100)
+        errors = []
+        # far behind the stream position, the writers wait for the earlier data
+        threads = [self._writer(sink, pos, bytes(50), errors) for pos in (200, 300)]
+        time.sleep(0.1)
+        self.assertTrue(all(thread.is_alive() for thread in threads))
+
+        sink.interrupt("Download terminated")
+        for thread in threads:
+            thread.join(5)
+
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertEqual([str(e) for e in errors], ["Download terminated"] * 2)
+        with self.assertRaises(EOFError):
+            sink.write(0, bytes(50))
+        self.assertEqual(out.getvalue(), b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
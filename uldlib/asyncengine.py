@@ -0,0 +1,286 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import aiohttp
+
+from uldlib.const import LINK_ERROR_CODES, PART_RETRIES, RETRY_BACKOFF, RETRY_BACKOFF_MAX
+from uldlib.downloader import Downloader
+from uldlib.part import DownloadPart
+from uldlib.utils import DownloaderError, LogLevel, PartError, backoff_delay
+
+# errors of broken or stalled connection, the part is downloaded again from the written offset
+NETWORK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError)
+
+
+class AsyncDownloader(Downloader):
+    """Downloader running all parts as asyncio tasks of one event loop instead of one thread per part.
+
+    Parts are streamed by aiohttp, download links are produced by the CAPTCHA
+    link generator running in an executor thread. Chunks are written (and hashed)
+    in threads of another executor, so a slow disk does not stall the other
+    connections, each part awaits its write before the next one. The event loop runs in its
+    own thread, so terminate() could be called from any thread (e.g. SIGINT
+    handler or frontend), it cancels all tasks.
+    """
+    loop: Optional[asyncio.AbstractEventLoop] = None
+    tasks: List[asyncio.Task]
+    http: aiohttp.ClientSession
+    writes: ThreadPoolExecutor
+    parts_use_sessions = False  # parts are streamed by aiohttp
+
+    def download(self, url: str, *args, **kwargs):
+        if kwargs.get("stream") is not None:
+            # writes into the stream block until the stream catches up, that would block the whole loop
+            raise DownloaderError("Writing into the output stream is not supported by the asyncio engine")
+        super().download(url, *args, **kwargs)
+
+    def terminate(self, quiet: bool = False):
+        loop = self.loop
+        if not self.terminating and loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._cancel_tasks)
+            except RuntimeError:
+                pass  # loop already closed
+        super().terminate(quiet)
+
+    def _cancel_tasks(self):
+        for task in asyncio.all_tasks(self.loop):
+            task.cancel()
+
+    def _start_part(self, part: DownloadPart, download_url: str):
+        """Start download of the part as a new task, must be called from the loop with parts_lock held"""
+        if self.stop_download.is_set():
+            return
+        part.download_url = download_url
+        self.tasks.append(self.loop.create_task(self._download_part_async(part)))
+
+    def _put_link(self, download_url: str):
+        self.download_url_queue.put_nowait(download_url)
+
+    def _get_spare_link(self) -> Optional[str]:
+        try:
+            return self.download_url_queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+
+    def _run_parts(self, unfinished: List[DownloadPart], download_url: str) -> bool:
+        # parts are streamed by aiohttp, the response of the size probe cannot be continued
+        self._close_probe()
+        self.tasks = []
+        self.loop = asyncio.new_event_loop()
+        engine = threading.Thread(target=self._run_loop, args=(unfinished, download_url))
+        with self.parts_lock:
+            # joined by terminate() as part threads of the threaded engine
+            self.threads.append(engine)
+        engine.start()
+        while engine.is_alive():
+            engine.join(1)
+        return True
+
+    def _run_loop(self, unfinished: List[DownloadPart], download_url: str):
+        asyncio.set_event_loop(self.loop)
+        links = ThreadPoolExecutor(thread_name_prefix="links")
+        self.loop.set_default_executor(links)
+        self.writes = ThreadPoolExecutor(thread_name_prefix="writes")
+        try:
+            self.loop.run_until_complete(self._run_parts_async(unfinished, download_url))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # writes of cancelled parts in progress are finished before the files are closed
+            self.writes.shutdown(wait=True)
+            # no more links are needed, solving in progress ends on stop_captcha (or stop_download)
+            self.stop_captcha.set()
+            if hasattr(self.loop, "shutdown_default_executor"):  # Python 3.9+
+                self.loop.run_until_complete(self.loop.shutdown_default_executor())
+            else:
+                links.shutdown(wait=False)
+            self.loop.close()
+
+    async def _run_parts_async(self, unfinished: List[DownloadPart], download_url: str):
+        # Prepare queue for recycling download URLs
+        self.download_url_queue = asyncio.Queue()
+
+        producer = None
+        if self.isLimited:
+            # Reuse already solved links
+            self.download_url_queue.put_nowait(download_url)
+
+        # connections are kept alive, no limit of connections (one for each part)
+        connector = aiohttp.TCPConnector(limit=0)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.conn_timeout, sock_read=self.conn_timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as self.http:
+            try:
+                for part in unfinished:
+                    if self.stop_download.is_set():
+                        return
+
+                    if self.isLimited:
+                        if producer is None:
+                            producer = self.loop.create_task(self._links_producer())
+                        part_url = await self.download_url_queue.get()
+                    else:
+                        part_url = download_url
+
+                    with self.parts_lock:
+                        self._start_part(part, part_url)
+
+                # no need for another links (also a signal for the prefetch of next files)
+                self.stop_captcha.set()
+                if self.isLimited:
+                    if self.isCaptcha:
+                        self.captcha_solver.log("All downloads started, no need to solve another CAPTCHAs…")
+                    else:
+                        self.captcha_solver.log("All downloads started, no need to solve another direct links…")
+
+                # Wait for all downloads to finish (tasks of split parts are added meanwhile)
+                i = 0
+                while i < len(self.tasks):
+                    done, _ = await asyncio.wait([self.tasks[i]], timeout=1)
+                    if done:
+                        i += 1
+                    else:
+                        self._monitor()
+            finally:
+                if producer is not None:
+                    producer.cancel()
+
+    async def _links_producer(self):
+        """Put links from the (blocking) CAPTCHA link generator into the queue, generator runs in executor"""
+        generator = self.captcha_download_links_generator
+        msg = "Solve direct dlink .." if self.page.isDirectDownload else "Solve CAPTCHA dlink .."
+        try:
+            while not self.stop_captcha.is_set():
+                url = await self.loop.run_in_executor(None, self._next_link, generator)
+                if url is None or self.stop_captcha.is_set():
+                    break
+                self.captcha_solver.log(msg)
+                self.download_url_queue.put_nowait(url)
+        except DownloaderError as e:
+            self.captcha_solver.log(str(e), level=LogLevel.ERROR)
+
+    async def _download_part_async(self, part: DownloadPart):
+        try:
+            try:
+                await self._download_part_retrying_async(part)
+            finally:
+                # persist written position also on error or terminate (for resume)
+                part.writer.close()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            part.exception = e
+            part.set_status(f"Error: {e}", error=True)
+
+    async def _download_part_retrying_async(self, part: DownloadPart):
+        """Download given part with retries (the same as _download_part_retrying of threaded engine)"""
+        attempt = 0
+        while True:
+            written = part.writer.written
+            try:
+                await self._download_part_internal_async(part)
+                return
+            except PartError as e:
+                error = e
+            except NETWORK_ERRORS as e:
+                error = PartError(f"Connection error: {e!r}")
+            if self.stop_download.is_set():
+                return
+
+            attempt = 1 if part.writer.written > written else attempt + 1
+            if attempt > PART_RETRIES:
+                raise error
+            delay = backoff_delay(attempt, RETRY_BACKOFF, RETRY_BACKOFF_MAX)
+            part.set_status(f"{error}, retry {attempt}/{PART_RETRIES} in {round(delay, 1)} s", warning=True)
+            await asyncio.sleep(delay)
+            if error.link_failed:
+                part.set_status("Waiting for a new download link…", warning=True)
+                download_url = self._get_spare_link()
+                if download_url is None:
+                    download_url = await self.loop.run_in_executor(None, self._solve_fresh_link, part.download_url)
+                if download_url is None:
+                    raise error
+                part.download_url = download_url
+
+    async def _download_part_internal_async(self, part: DownloadPart):
+        """Download given part of the download (the same as _download_part_internal of threaded engine)"""
+        writer = part.writer
+
+        part.lock.acquire()
+        if not part.started:
+            part.started = True
+            part.start_time = time.time()
+        part.lock.release()
+
+        while True:
+            if self.stop_download.is_set():
+                return
+
+            part.set_status("Starting download")
+            r = await self.http.get(part.download_url, allow_redirects=True, headers={
+                "Range": "bytes={}-{}".format(writer.pfrom + writer.written, writer.pto),
+            })
+
+            if r.status in (429, 425):
+                # read the short error page, so the connection could be reused by the next attempt
+                await r.read()
+                r.release()
+                with self.parts_lock:
+                    self.throttled += 1
+            if r.status == 429:
+                part.set_status("Status code 429 Too Many Requests returned… will try again in few seconds", warning=True)
+                await asyncio.sleep(5)
+            elif r.status == 425:
+                part.set_status("Status code 425 Too Early returned… will try again in few seconds", warning=True)
+                await asyncio.sleep(5)
+            else:
+                break
+
+        try:
+            if r.status != 206 and r.status != 200:
+                raise PartError(f"Status code {r.status} returned: {writer.pfrom + writer.written}/{writer.pto}",
+                                link_failed=r.status in LINK_ERROR_CODES)
+
+            part.set_status("")
+            self._first_byte()
+
+            async for chunk in r.content.iter_any():
+                wrt = await self.loop.run_in_executor(self.writes, writer.write, chunk)
+
+                part.lock.acquire()
+                part.d_now += wrt
+                part.d_total += wrt
+                part.lock.release()
+
+                if self.limiter is not None:
+                    delay = self.limiter.consume(self.bucket, wrt)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+                if writer.remaining() == 0:
+                    # end of the part (could be shortened by split meanwhile)
+                    break
+
+                if self.stop_download.is_set():
+                    return
+        finally:
+            # connection is kept only when the whole response was read
+            r.release()
+
+        # download end status
+        if writer.remaining() > 0:
+            raise PartError(f"Connection closed before the end of the part: {writer.pfrom + writer.written}/{writer.pto}")
+
+        part.lock.acquire()
+        part.completed = True
+        part.completion_time = time.time()
+        part.lock.release()
+
+        # close part file files
+        writer.close()
+
+        # reuse download link for another part
+        self._reuse_link(part.download_url)
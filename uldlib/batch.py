@@ -0,0 +1,125 @@
+import threading
+from typing import Callable, Dict, List
+
+from uldlib.downloader import Downloader
+from uldlib.frontend import FileFrontend, Frontend
+from uldlib.utils import DownloaderStopped, LogLevel
+
+DownloaderFactory = Callable[[Frontend, threading.Lock], Downloader]
+
+
+class BatchDownloader:
+    """Downloads files of the batch concurrently, each one by its own Downloader.
+
+    At most `jobs` files are downloaded at once and all of them use at most
+    `max_connections` parallel parts: a file gets `parts` connections or what
+    is left of the budget, files wait for the budget returned by finished ones.
+    All downloaders share one links lock and the Tor pool: links of a file are solved
+    one at a time under the lock, or by link workers of the file over the shared Tor instances.
+    Each file has its own frontend (FileFrontend), .udown and link cache.
+    """
+    frontend: Frontend
+    jobs: int
+    parts: int
+    max_connections: int
+
+    # Condition and protected variables
+    cond: threading.Condition
+    active: Dict[int, Downloader]
+    used_connections: int
+    terminating: bool
+
+    def __init__(self, factory: DownloaderFactory, frontend: Frontend, jobs: int, parts: int, max_connections: int = 0):
+        """
+        Arguments:
+            factory: creates Downloader for given frontend and shared links lock
+            frontend: frontend shared by all files
+            jobs: number of files downloaded concurrently
+            parts: number of parts of each file
+            max_connections: limit of parallel parts of all files (0 = jobs * parts)
+        """
+        self.factory = factory
+        self.frontend = frontend
+        self.jobs = jobs
+        self.parts = parts
+        self.max_connections = max_connections or jobs * parts
+        self.links_lock = threading.Lock()
+        self.prompt_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.active = {}
+        self.used_connections = 0
+        self.terminating = False
+
+    def download(self, urls: List[str], **kwargs) -> List[str]:
+        """Download all URLs, kwargs are passed to Downloader.download (except url and parts).
+
+            Returns:
+                List[str]: URLs which failed
+        """
+        done: List[str] = []
+        failed: List[str] = []
+        threads = []
+        pending = list(enumerate(urls))
+        self.frontend.main_log(f"Batch of {len(urls)} files: {self.jobs} at once, "
+                               f"at most {self.max_connections} connections")
+
+        with self.cond:
+            while pending and not self.terminating:
+                if len(self.active) >= self.jobs or self.used_connections >= self.max_connections:
+                    self.cond.wait()
+                    continue
+                (index, url) = pending.pop(0)
+                parts = min(self.parts, self.max_connections - self.used_connections)
+                self.used_connections += parts
+                name = f"{index + 1}/{len(urls)}"
+                d = self.factory(FileFrontend(self.frontend, name, self.prompt_lock), self.links_lock)
+                self.active[index] = d
+                t = threading.Thread(target=self._download_file, args=(d, index, url, parts, kwargs, done, failed))
+                threads.append(t)
+                t.start()
+
+        for t in threads:
+            t.join()
+
+        stopped = len(urls) - len(done) - len(failed)
+        level = LogLevel.SUCCESS if len(done) == len(urls) else LogLevel.WARNING
+        self.frontend.main_log(f"Batch finished: {len(done)} downloaded, {len(failed)} failed, {stopped} stopped or not started",
+                               level=level)
+        for url in failed:
+            self.frontend.main_log(f"Failed: {url}", level=LogLevel.ERROR)
+        return failed
+
+    def _download_file(self, d: Downloader, index: int, url: str, parts: int, kwargs: dict, done: List[str], failed: List[str]):
+        try:
+            d.download(url, parts, **kwargs)
+            if not d.success:
+                return  # stopped by terminate before all parts were started
+            # do clean only on successful download
+            d.clean()
+            with self.cond:
+                done.append(url)
+        except DownloaderStopped:
+            pass
+        except Exception as e:
+            if self.terminating:
+                return  # failure of parts stopped by terminate
+            d.frontend.main_log(str(e), level=LogLevel.ERROR)
+            with self.cond:
+                failed.append(url)
+        finally:
+            if not d.terminating:
+                d.terminate(quiet=True)
+            with self.cond:
+                del self.active[index]
+                self.used_connections -= parts
+                self.cond.notify_all()
+
+    def terminate(self):
+        """Stop all running downloads, no other file is started"""
+        with self.cond:
+            self.terminating = True
+            active = list(self.active.values())
+            self.cond.notify_all()
+        for d in active:
+            # also downloads whose thread has not started download() yet
+            d.cancel()
@@ -14,6 +14,8 @@ from uldlib.utils import LogLevel
 class CaptchaSolver():
     frontend: Frontend
     cannot_solve: bool = False
+    # shared session for fetching of images (set by the downloader), new connection for each image when None
+    session: requests.Session = None
 
     def __init__(self, frontend: Frontend):
         self.frontend = frontend
@@ -24,6 +26,10 @@ class CaptchaSolver():
     def stats(self, stats: Dict[str, int]):
         self.frontend.captcha_stats(stats)
 
+    def _get_image(self, img_url: str) -> bytes:
+        get = self.session.get if self.session is not None else requests.get
+        return get(img_url).content
+
     @abstractmethod
     def solve(self, img_url: str, stop_event: threading.Event = None) -> str:
         pass
@@ -45,8 +51,14 @@ class ManualInput(CaptchaSolver):
 
     def __init__(self, frontend):
         super().__init__(frontend)
+        # one window at a time when links are solved in parallel
+        self.lock = threading.Lock()
 
     def solve(self, img_url: str, stop_event: threading.Event = None) -> str:
+        with self.lock:
+            return self._solve(img_url, stop_event)
+
+    def _solve(self, img_url: str, stop_event: threading.Event = None) -> str:
         import tkinter as tk
         from PIL import ImageTk
 
@@ -66,8 +78,7 @@ class ManualInput(CaptchaSolver):
 
         root.protocol("WM_DELETE_WINDOW", disable_event)
 
-        u = requests.get(img_url)
-        raw_data = u.content
+        raw_data = self._get_image(img_url)
 
         im = Image.open(BytesIO(raw_data))
         photo = ImageTk.PhotoImage(im)
@@ -146,6 +157,8 @@ class AutoReadCaptcha(CaptchaSolver):
 
         model_content = open(model_path, "rb").read()
         self.interpreter = tflite.Interpreter(model_content=model_content)
+        # the interpreter is not thread safe (images of parallel solvers are fetched concurrently)
+        self.lock = threading.Lock()
 
     def solve(self, img_url, stop_event=None) -> str:
         # stop_event not used, because tflite interpreter is hard to cancel (but is is quick)
@@ -155,8 +168,7 @@ class AutoReadCaptcha(CaptchaSolver):
 
         self.log("Auto solving CAPTCHA")
 
-        u = requests.get(img_url)
-        raw_data = u.content
+        raw_data = self._get_image(img_url)
 
         img = Image.open(BytesIO(raw_data))
         img = np.asarray(img)
@@ -175,14 +187,15 @@ class AutoReadCaptcha(CaptchaSolver):
         # input is now of shape (batch_size, 70, 175, 1)
         # output will have shape (batch_size, 4, 26)
 
-        interpreter.allocate_tensors()
-        input_details = interpreter.get_input_details()
-        output_details = interpreter.get_output_details()
-        interpreter.set_tensor(input_details[0]['index'], input)
-        interpreter.invoke()
+        with self.lock:
+            interpreter.allocate_tensors()
+            input_details = interpreter.get_input_details()
+            output_details = interpreter.get_output_details()
+            interpreter.set_tensor(input_details[0]['index'], input)
+            interpreter.invoke()
 
-        # predict and get the output
-        output = interpreter.get_tensor(output_details[0]['index'])
+            # predict and get the output
+            output = interpreter.get_tensor(output_details[0]['index'])
         # now get labels
         labels_indices = np.argmax(output, axis=2)
 
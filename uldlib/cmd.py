@@ -2,12 +2,18 @@ import argparse
 import importlib.util
 import signal
 import os
+import threading
 import sys
 from os import path
-from uldlib import downloader, captcha, __version__, __path__, const
-from uldlib.frontend import ConsoleFrontend, JSONFrontend
+from uldlib import downloader, captcha, segfile, __version__, __path__, const
+from uldlib.batch import BatchDownloader
+from uldlib.frontend import ConsoleFrontend, FileFrontend, JSONFrontend
+from uldlib.page import Page
+from uldlib.prefetch import Prefetcher
+from uldlib.ratelimit import RateLimiter, parse_rate
 from uldlib import utils
-from uldlib.torrunner import TorRunner
+from uldlib.session import SessionPool
+from uldlib.torrunner import TorPool
 from uldlib.utils import LogLevel
 
 # TODO Automatic find all types implementing Frontend and put into this dict
@@ -24,26 +30,98 @@ def run():
 
     parser.add_argument(
         'urls', metavar='URL', nargs="+", type=str,
-        help="URL from Uloz.to (tip: enter in 'quotes' because the URL contains ! sign). Multiple URLs could be specified, they will be downloaded sequentially.")
+        help="URL from Uloz.to (tip: enter in 'quotes' because the URL contains ! sign). Multiple URLs could be specified, "
+             "they will be downloaded sequentially (or concurrently with --jobs).")
 
     g_main = parser.add_argument_group("Main options")
     g_main.add_argument(
         '--parts', metavar='N', type=int, default=20,
         help='Number of parts that will be downloaded in parallel')
+    g_main.add_argument(
+        '--segment-size', metavar='MB', type=int, default=0,
+        help='Slice the file into segments of this size downloaded by --parts workers one after another '
+             '(each worker keeps its download link), 0 = one segment for each part. '
+             'Layout of a resumed download is not changed')
+    g_main.add_argument(
+        '--straggler-factor', metavar='F', type=float, default=const.STRAGGLER_FACTOR,
+        help='Give the tail of a slow part to a spare download link when its remaining time exceeds '
+             'the median of parts (idle links count as zero) this many times, 0 = disabled')
+    g_main.add_argument(
+        '--adaptive', default=False, action="store_true",
+        help='Adapt the number of parallel parts to the throughput (AIMD): quick downloads start with '
+             f'{const.ADAPTIVE_START} parts and add one while the throughput improves, any download backs off '
+             'on 429/425 responses or collapsed speed of parts. --parts is the maximum, --segment-size defaults '
+             f'to {const.ADAPTIVE_SEGMENT_SIZE // 1024**2} MB (larger for files over '
+             f'{const.ADAPTIVE_MAX_SEGMENTS * const.ADAPTIVE_SEGMENT_SIZE // 1024**3} GB, at most {const.ADAPTIVE_MAX_SEGMENTS} segments)')
+    g_main.add_argument(
+        '--engine', type=str, default="threads", choices=("threads", "asyncio"),
+        help="How parts are downloaded: 'threads' - each part in its own thread, "
+             "'asyncio' - all parts in a single event loop (needs aiohttp, better for hundreds of parts)")
+    g_main.add_argument(
+        '--jobs', metavar='N', type=int, default=1,
+        help='Number of files (URLs) downloaded concurrently, they share Tor and CAPTCHA solving '
+             '(links are solved one at a time for all files) and progress is logged instead of the status panel')
+    g_main.add_argument(
+        '--max-connections', metavar='N', type=int, default=0,
+        help='Limit of parallel parts of all files downloaded concurrently (--jobs), '
+             'each file gets --parts or what is left, 0 = --jobs x --parts')
+    g_main.add_argument(
+        '--prefetch', metavar='N', type=int, default=0,
+        help='While a file is downloaded, load pages of the next N files (URLs) and solve their download links '
+             'in advance when they are expected to be still valid at the start of the file, 0 = disabled')
     g_main.add_argument(
         '--password', metavar='P', type=str, default="",
         help='Optional password if the file is password-protected')
 
     g_main.add_argument(
         '--output', metavar='DIRECTORY', type=str, default="./",
-        help='Directory or full path including file name where output file will be saved')
+        help="Directory or full path including file name where output file will be saved, "
+             "'-' for writing into the standard output (all messages go to the standard error output)")
     g_main.add_argument(
         '--temp', metavar='DIRECTORY', type=str, default="./",
-        help='Directory where temporary files (.ucache, .udown, Tor data directory) will be created')
+        help='Directory where temporary files (links database, .udown, Tor data directory) will be created')
     g_main.add_argument(
         '-y', '--yes', default=False, action="store_true",
         help='Overwrite files without asking')
 
+    g_out = parser.add_argument_group("Output writing options")
+    g_out.add_argument(
+        '--write-mode', type=str, default=segfile.WRITE_MODE_FILE, choices=segfile.WRITE_MODES,
+        help="How parts are written into the output file: 'file' - own buffered file handle for each part, "
+             "'mmap' - output and .udown files mapped into memory and shared by all parts, "
+             "'pwrite' - one shared descriptor for output and .udown file with positional writes (not on Windows)")
+    g_out.add_argument(
+        '--preallocate', default=False, action="store_true",
+        help='Allocate the whole output file on the disk before the download starts (posix_fallocate, '
+             'falls back to a sparse file when not supported by the filesystem)')
+    g_out.add_argument(
+        '--hash', metavar='MODE', type=str, default=None, choices=segfile.HASH_MODES,
+        help="Hash data while downloading (without reading the file again) and write manifest with SHA-256 digests "
+             "of 1 MB blocks next to the output file: 'blocks' - only block digests, "
+             "'tree' - also whole file digest made of block digests")
+    g_out.add_argument(
+        '--stream-buffer', metavar='MB', type=int, default=const.STREAM_BUFFER // 1024**2,
+        help="Memory for reordering of parts downloaded in parallel when writing into the standard output (--output -), "
+             "parts too far ahead wait until the output catches up")
+    g_out.add_argument(
+        '--checkpoint-bytes', metavar='BYTES', type=int, default=const.CHECKPOINT_BYTES,
+        help='Persist progress of each part into the .udown file at latest after this number of written bytes')
+    g_out.add_argument(
+        '--checkpoint-interval', metavar='MS', type=int, default=const.CHECKPOINT_INTERVAL,
+        help='Persist progress of each part into the .udown file at latest after this number of milliseconds')
+
+    g_rate = parser.add_argument_group("Bandwidth limit options")
+    g_rate.add_argument(
+        '--rate-limit', metavar='RATE', type=parse_rate, default=0,
+        help='Limit of the aggregate rate of all parts (bytes per second, K/M/G suffixes allowed, e.g. 2M), 0 = unlimited')
+    g_rate.add_argument(
+        '--download-rate-limit', metavar='RATE', type=parse_rate, default=0,
+        help='Limit of the rate of each download (bytes per second, K/M/G suffixes allowed), 0 = unlimited')
+    g_rate.add_argument(
+        '--rate-limit-file', metavar='FILE', type=str, default=None,
+        help="Control file checked every second for changed limits, lines 'rate-limit=RATE' "
+             "and 'download-rate-limit=RATE' override the options above while running")
+
     g_log = parser.add_argument_group("Display and logging options")
     g_log.add_argument(
         '--parts-progress', default=False, action='store_true',
@@ -70,6 +148,14 @@ def run():
     g_tor.add_argument(
         '--conn-timeout', metavar='SEC', default=const.DEFAULT_CONN_TIMEOUT, type=int,
         help='Set connection timeout for TOR sessions in seconds')
+    g_tor.add_argument(
+        '--tor-instances', metavar='N', default=1, type=int,
+        help='Number of TOR processes (each with its own ports and data directory), download links are solved '
+             'over all of them in parallel, additional ones are started when first needed')
+    g_tor.add_argument(
+        '--link-workers', metavar='K', default=0, type=int,
+        help='Number of concurrent download link workers (CAPTCHA attempts in progress at once), they share the TOR '
+             'processes. Default: one for each TOR process')
 
     g_other = parser.add_argument_group("Other options")
     g_other.add_argument('--version', action='version', version=__version__)
@@ -77,6 +163,17 @@ def run():
 
     args = parser.parse_args()
 
+    stream = None
+    if args.output == '-':
+        if args.hash:
+            parser.error("--hash cannot be used with --output -")
+        if args.jobs > 1:
+            parser.error("--jobs cannot be used with --output -")
+        # downloaded data go to the original standard output, everything printed goes to the standard error output
+        sys.stdout.flush()
+        stream = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
     # Use user chosen frontend
     frontend = available_frontends[args.frontend](show_parts=args.parts_progress, logfile=args.log)
 
@@ -101,18 +198,34 @@ def run():
                 level=LogLevel.WARNING
             )
 
-    if args.auto_captcha:
-        if not (tfull_available or tflite_available):
-            frontend.main_log('ERROR: --auto-captcha used but neither tensorflow.lite nor tflite_runtime are available', level=LogLevel.ERROR)
+    if args.auto_captcha and not (tfull_available or tflite_available):
+        frontend.main_log('ERROR: --auto-captcha used but neither tensorflow.lite nor tflite_runtime are available', level=LogLevel.ERROR)
+        sys.exit(1)
+    if args.manual_captcha and not args.auto_captcha and not tkinter_available:
+        frontend.main_log('ERROR: --manual-captcha used but tkinter not available', level=LogLevel.ERROR)
+        sys.exit(1)
+
+    if args.engine == "asyncio":
+        if not importlib.util.find_spec('aiohttp'):
+            frontend.main_log('ERROR: --engine asyncio used but aiohttp not available', level=LogLevel.ERROR)
+            sys.exit(1)
+        if stream is not None:
+            frontend.main_log('ERROR: --engine asyncio cannot be used with --output -', level=LogLevel.ERROR)
             sys.exit(1)
+        from uldlib.asyncengine import AsyncDownloader
+        downloader_class = AsyncDownloader
+    else:
+        downloader_class = downloader.Downloader
+
+    # Tor bootstraps in the background while the CAPTCHA model is loaded and the first page is fetched
+    tor_pool = TorPool(args.tor_instances, args.temp, frontend.tor_log)
+    tor = tor_pool.main
+    tor_pool.launch_background()
 
+    if args.auto_captcha:
         model_path = path.join(__path__[0], const.MODEL_FILENAME)
         solver = captcha.AutoReadCaptcha(model_path, const.MODEL_DOWNLOAD_URL, frontend)
     elif args.manual_captcha:
-        if not tkinter_available:
-            frontend.main_log('ERROR: --manual-captcha used but tkinter not available', level=LogLevel.ERROR)
-            sys.exit(1)
-
         solver = captcha.ManualInput(frontend)
     else:
         solver = captcha.Dummy(frontend)
@@ -124,23 +237,54 @@ def run():
     from colorama import just_fix_windows_console
     just_fix_windows_console()
 
-    tor = TorRunner(args.temp, frontend.tor_log)
-    d = downloader.Downloader(tor, frontend, solver)
+    checkpoint_policy = segfile.CheckpointPolicy(args.checkpoint_bytes, args.checkpoint_interval)
+
+    limiter = None
+    if args.rate_limit or args.download_rate_limit or args.rate_limit_file:
+        limiter = RateLimiter(args.rate_limit, args.download_rate_limit, args.rate_limit_file, frontend.main_log)
+        limiter.poll()
+    download_kwargs = dict(
+        password=args.password, target_dir=args.output, temp_dir=args.temp, do_overwrite=args.yes,
+        conn_timeout=args.conn_timeout, enforce_tor=args.enforce_tor,
+        checkpoint_policy=checkpoint_policy, write_mode=args.write_mode, preallocate=args.preallocate,
+        hash_mode=args.hash, stream=stream, stream_buffer=args.stream_buffer * 1024**2,
+        segment_size=args.segment_size * 1024**2, straggler_factor=args.straggler_factor,
+        adaptive=args.adaptive)
+
+    if args.jobs > 1:
+        run_batch(args, frontend, tor_pool, solver, downloader_class, limiter, download_kwargs)
+        return
+
+    d = downloader_class(tor, frontend, solver, limiter=limiter, tor_pool=tor_pool, link_workers=args.link_workers)
+
+    prefetcher = None
+    if args.prefetch > 0 and len(args.urls) > 1:
+        # prompts (password) are left to the download itself
+        prefetch_frontend = FileFrontend(frontend, "prefetch", threading.Lock(), supports_prompt=False)
+        prefetcher = Prefetcher(
+            args.prefetch, args.parts,
+            lambda url: Page(url=url, temp_dir=args.temp, parts=args.parts, password=args.password, frontend=prefetch_frontend,
+                             tor=tor, enforce_tor=args.enforce_tor, conn_timeout=args.conn_timeout),
+            solver, prefetch_frontend.main_log)
 
     # Register sigint handler
     def sigint_handler(sig, frame):
         if d.terminating:
             return  # Already terminating
         d.terminate()
-        tor.stop()
+        tor_pool.stop()
         frontend.main_log('Program terminated.')
         sys.exit(1)
 
     signal.signal(signal.SIGINT, sigint_handler)
 
     try:
-        for url in args.urls:
-            d.download(url, args.parts, args.password, args.output, args.temp, args.yes, args.conn_timeout, args.enforce_tor)
+        for (i, url) in enumerate(args.urls):
+            page = None
+            if prefetcher is not None:
+                page = prefetcher.take(url)
+                prefetcher.follow(d, args.urls[i + 1:])
+            d.download(url, args.parts, page=page, **download_kwargs)
             # do clean only on successful download (no exception)
             d.clean()
     except utils.DownloaderStopped:
@@ -148,5 +292,33 @@ def run():
     except utils.DownloaderError as e:
         frontend.main_log(str(e), level=LogLevel.ERROR)
     finally:
+        if prefetcher is not None:
+            prefetcher.stop()
         d.terminate()
-        tor.stop()
+        tor_pool.stop()
+
+
+def run_batch(args, frontend, tor_pool, solver, downloader_class, limiter, download_kwargs):
+    """Download all URLs concurrently (--jobs) with shared Tor, CAPTCHA solver, connections and rate limit"""
+    max_connections = args.max_connections or args.jobs * args.parts
+    sessions = SessionPool(max_connections)
+    batch = BatchDownloader(
+        lambda file_frontend, links_lock: downloader_class(tor_pool.main, file_frontend, solver, sessions=sessions, limiter=limiter,
+                                                           links_lock=links_lock, tor_pool=tor_pool,
+                                                           link_workers=args.link_workers),
+        frontend, args.jobs, args.parts, max_connections)
+
+    # Register sigint handler
+    def sigint_handler(sig, frame):
+        if batch.terminating:
+            return  # Already terminating
+        frontend.main_log('Terminating all downloads. Please wait for stopping all threads.', level=LogLevel.WARNING)
+        batch.terminate()
+
+    signal.signal(signal.SIGINT, sigint_handler)
+
+    try:
+        batch.download(args.urls, **download_kwargs)
+    finally:
+        batch.terminate()
+        tor_pool.stop()
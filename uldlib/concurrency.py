@@ -0,0 +1,92 @@
+from typing import Callable, Optional
+
+from uldlib.const import ADAPTIVE_COLLAPSE, ADAPTIVE_GAIN, ADAPTIVE_INTERVAL
+from uldlib.utils import LogLevel
+
+
+class ConcurrencyController:
+    """AIMD controller of the number of parts downloaded in parallel.
+
+    The aggregate throughput is evaluated every `interval` seconds:
+    - 429/425 responses, or collapse of the per-connection speed (below `collapse`
+      share of the best one seen) together with drop of the throughput - multiplicative
+      decrease (halved)
+    - throughput improved at least by `gain` over the previous limit - additive increase (+1)
+    - otherwise the limit is kept (more connections do not help)
+    """
+    limit: int
+    maximum: int
+
+    def __init__(self, start: int, maximum: int, log_func: Callable, interval: float = ADAPTIVE_INTERVAL,
+                 gain: float = ADAPTIVE_GAIN, collapse: float = ADAPTIVE_COLLAPSE):
+        self.limit = max(1, min(start, maximum))
+        self.maximum = maximum
+        self.log_func = log_func
+        self.interval = interval
+        self.gain = gain
+        self.collapse = collapse
+        self.last_time: Optional[float] = None
+        self.last_downloaded = 0
+        self.last_throttled = 0
+        # throughput of the previous limit and the best per-connection speed (bytes per second)
+        self.base: Optional[float] = None
+        self.best_per_conn = 0.0
+
+    def update(self, now: float, downloaded: int, throttled: int, running: int) -> int:
+        """Evaluate measurements and return the new limit.
+
+        Arguments:
+            now: current time in seconds
+            downloaded: total bytes downloaded by all parts so far
+            throttled: total number of 429/425 responses so far
+            running: number of parts running now
+        """
+        if self.last_time is None:
+            self._reset(now, downloaded, throttled)
+            return self.limit
+        elapsed = now - self.last_time
+        if elapsed < self.interval:
+            return self.limit
+
+        throughput = (downloaded - self.last_downloaded) / elapsed
+        per_conn = throughput / max(running, 1)
+        new_throttled = throttled - self.last_throttled
+        self._reset(now, downloaded, throttled)
+
+        if new_throttled > 0:
+            self._set_limit(self.limit // 2, f"{new_throttled} responses 429/425", throughput, per_conn)
+            self.base = throughput
+        elif (running > 1 and per_conn < self.collapse * self.best_per_conn
+              and self.base is not None and throughput < self.base):
+            self._set_limit(self.limit // 2, f"per-connection speed collapsed (best {self._mb(self.best_per_conn)}), "
+                            f"throughput dropped (was {self._mb(self.base)})", throughput, per_conn)
+            self.base = throughput
+        elif running < self.limit:
+            # not enough parts to use the limit (e.g. near the end), nothing to judge
+            pass
+        elif self.base is None or throughput >= self.base * (1 + self.gain):
+            prev = "first measurement" if self.base is None else f"was {self._mb(self.base)}"
+            self._set_limit(self.limit + 1, f"throughput improving ({prev})", throughput, per_conn)
+            # the next limit has to beat throughput of this one
+            self.base = throughput
+        self.best_per_conn = max(self.best_per_conn, per_conn)
+        return self.limit
+
+    def _reset(self, now: float, downloaded: int, throttled: int):
+        self.last_time = now
+        self.last_downloaded = downloaded
+        self.last_throttled = throttled
+
+    def _set_limit(self, limit: int, reason: str, throughput: float, per_conn: float):
+        limit = max(1, min(limit, self.maximum))
+        if limit == self.limit:
+            return
+        self.log_func(
+            f"Parallel connections {self.limit} -> {limit}: {reason}, "
+            f"throughput {self._mb(throughput)}, per connection {self._mb(per_conn)}",
+            level=LogLevel.WARNING if limit < self.limit else LogLevel.INFO)
+        self.limit = limit
+
+    @staticmethod
+    def _mb(bps: float) -> str:
+        return f"{bps / 1024**2:.2f} MB/s"
@@ -1,14 +1,52 @@
 CLI_STATUS_STARTLINE = 5
+BATCH_PROGRESS_INTERVAL = 10  # s, progress of each file in batch mode is logged this often
 XML_HEADERS = {
     "Accept-Encoding": "gzip",
     "X-Requested-With": "XMLHttpRequest",
     # "User-Agent": "Go-http-client/1.1",
 }
 DOWNPOSTFIX = '.udown'
-CACHEPOSTFIX = '.ucache'
+CACHEPOSTFIX = '.ucache'  # legacy text cache of links, imported into LINKCACHE_DB
+LINKCACHE_DB = 'links.sqlite'  # cached download links of all files in --temp
+LINKCACHE_TIMEOUT = 30  # s, waiting for the lock of the database held by another process
+HASHPOSTFIX = '.uhash'
+MANIFESTPOSTFIX = '.manifest.json'
 DOWN_CHUNK_SIZE = 20480
 OUTFILE_WRITE_BUF = 20480
+RECV_BUFFER_MAX = 1024**2  # receive buffer of a part grows from DOWN_CHUNK_SIZE up to this size
+RECV_BUFFER_TIME = 100  # ms, the receive buffer is sized to be filled in about this time
+CHECKPOINT_BYTES = 4 * 1024**2
+CHECKPOINT_INTERVAL = 1000  # ms
+MIN_SPLIT_SIZE = 1024**2  # split only parts with at least 2 * MIN_SPLIT_SIZE remaining
+STRAGGLER_FACTOR = 3  # part is a straggler when its remaining time exceeds the median this many times
+STRAGGLER_MIN_TIME = 5  # s, minimal time of measured speed and of remaining time of a straggler
+STRAGGLER_MIN_SPLIT = 256 * 1024
+PART_RETRIES = 10  # failed attempts of a part in a row (without any progress) before the part fails
+RETRY_BACKOFF = 1  # s, delay before the first retry of a part, doubled with each next attempt (with jitter)
+RETRY_BACKOFF_MAX = 60  # s
+LINK_ERROR_CODES = (401, 403, 404, 410)  # status codes of expired or blocked download links
+ADAPTIVE_START = 2  # parallel connections of quick downloads at the start with --adaptive
+ADAPTIVE_INTERVAL = 5  # s, throughput is evaluated after each interval
+ADAPTIVE_GAIN = 0.1  # another connection is added while throughput improves at least by this share
+ADAPTIVE_COLLAPSE = 0.5  # back off when per-connection speed drops below this share of the best one
+ADAPTIVE_SEGMENT_SIZE = 8 * 1024**2  # default segment size with --adaptive (workers are parked between segments)
+ADAPTIVE_MAX_SEGMENTS = 256  # default segments of large files are bigger, so that there are at most this many
+HASH_BLOCK_SIZE = 1024**2
+STREAM_BUFFER = 64 * 1024**2  # reorder buffer when writing into stdout / pipe
+RATE_LIMIT_BURST = 0.5  # s, unused bandwidth saved by the rate limiter
+PREFETCH_INTERVAL = 1  # s, the look-ahead stage re-estimates the start of next files this often
+PREFETCH_LINK_VALIDITY = 300  # s, assumed validity of download links until the first prefetched one is solved
+PREFETCH_LINK_MARGIN = 60  # s, prefetched links must stay valid at least this long after the expected start of their file
 DEFAULT_CONN_TIMEOUT = 30
+POOL_HOSTS = 16  # number of hosts with kept connections
 MODEL_DOWNLOAD_URL = "https://github.com/JanPalasek/ulozto-captcha-breaker/releases/download/v2.2/model.tflite"
 TOR_DATA_DIR_PREFIX = "tor_data_dir_"
+TOR_DATA_DIRS_MAX = 32  # data directories of concurrently running instances
+TOR_CONSENSUS_MAX_AGE = 24 * 3600  # s, cached consensus older than this is not usable for a warm bootstrap
+TOR_STOP_TIMEOUT = 5  # s, Tor is killed when it does not exit after termination
+EXIT_REPUTATION_FILE = "tor_exits.json"  # reputation of exit relays in --temp
+EXIT_HALF_LIFE = 1800  # s, penalty of a limited or blocked exit is halved this often
+EXIT_BAD_SCORE = 0.5  # exits with at least this penalty are excluded
+EXIT_MIN_SCORE = 0.05  # exits with a lower penalty are forgotten
+EXIT_EXCLUDE_MAX = 500  # excluded exits at most (the worst ones)
 MODEL_FILENAME = "model.tflite"
@@ -1,26 +1,57 @@
+import http.client
 import os
-from queue import Queue
-import requests
+from math import ceil
+from queue import Empty, Queue
+import shutil
+import socket
+import statistics
 import threading
 import time
-from typing import List, Type
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Type
+
+import requests
+import urllib3
 
 from uldlib.captcha import CaptchaSolver
-from uldlib.const import DOWNPOSTFIX, DOWN_CHUNK_SIZE, DEFAULT_CONN_TIMEOUT
+from uldlib.concurrency import ConcurrencyController
+from uldlib.const import DOWNPOSTFIX, DOWN_CHUNK_SIZE, DEFAULT_CONN_TIMEOUT, HASHPOSTFIX, MANIFESTPOSTFIX, MIN_SPLIT_SIZE, STREAM_BUFFER, \
+    STRAGGLER_FACTOR, STRAGGLER_MIN_SPLIT, STRAGGLER_MIN_TIME, ADAPTIVE_SEGMENT_SIZE, ADAPTIVE_START, LINK_ERROR_CODES, PART_RETRIES, \
+    RETRY_BACKOFF, RETRY_BACKOFF_MAX, ADAPTIVE_MAX_SEGMENTS
 from uldlib.frontend import DownloadInfo, Frontend
 from uldlib.page import Page
 from uldlib.part import DownloadPart
-from uldlib.segfile import SegFileLoader
-from uldlib.torrunner import TorRunner
-from uldlib.utils import DownloaderError, DownloaderStopped, LogLevel
+from uldlib.ratelimit import RateLimiter, TokenBucket
+from uldlib.session import SessionPool, content_range_size, release
+from uldlib.segfile import HASH_MODE_TREE, WRITE_MODE_FILE, CheckpointPolicy, SegFileLoader, StreamLoader, missing_space, \
+    stat_file_total_size
+from uldlib.torrunner import TorPool, TorRunner
+from uldlib.utils import DownloaderError, DownloaderStopped, LogLevel, PartError, backoff_delay
+
+# errors of broken or stalled connection, the part is downloaded again from the written offset
+NETWORK_ERRORS = (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, http.client.HTTPException,
+                  ConnectionError, TimeoutError, socket.timeout)
 
 
 class Downloader:
-    terminating: bool
+    # True also before the first download (there is nothing to terminate)
+    terminating: bool = True
+    # set by cancel(), a download not started yet is not started at all
+    cancelled: bool = False
 
     threads: List[threading.Thread]
     stop_download: threading.Event
 
+    # Lock and protected variables (used by part threads when handing over links)
+    parts_lock: threading.Lock
+    downloads: List[DownloadPart]
+    pending_parts: List[DownloadPart]
+    throttled: int
+    links_obtained: int  # links for parts of the download got from the cache or solved by link workers
+    links_solving: int  # attempts of link workers in progress
+    links_needed: Optional[int]  # links needed by the parts, None until a resumed download is loaded
+    links_cond: threading.Condition  # on parts_lock, notified when links_needed is known
+
     frontend: Type[Frontend]
     frontend_thread: threading.Thread = None
     stop_frontend: threading.Event
@@ -28,19 +59,45 @@ class Downloader:
     captcha_solver: Type[CaptchaSolver]
     captcha_thread: threading.Thread = None
     stop_captcha: threading.Event
+    # only one download link is solved at a time (CAPTCHA thread and parts replacing failed links)
+    links_lock: threading.Lock
+    # Tor instances used for solving links, spread over the link workers
+    tor_pool: Optional[TorPool] = None
+    link_workers: int  # links are solved by concurrent workers when more than one
 
     download_url_queue: Queue
+    # link usable by any number of parts (quick download), None when each part needs its own link
+    reusable_url: Optional[str] = None
+    concurrency: Optional[ConcurrencyController] = None
+    sessions: SessionPool
+    # parts are downloaded over connections of the sessions (statistics are logged)
+    parts_use_sessions: bool = True
+    limiter: Optional[RateLimiter]
+    bucket: Optional[TokenBucket] = None
+    probe: Optional[requests.Response] = None  # response of the size probe kept for the part at the file start
+    download_start: float = None
+    ttfb: Optional[float] = None  # s from the start of the download to the first response with data
+    file_data: SegFileLoader = None
     parts: int
     tor: TorRunner
     page: Page
 
     password: str
 
-    def __init__(self, tor: TorRunner, frontend: Type[Frontend], captcha_solver: Type[CaptchaSolver]):
+    def __init__(self, tor: TorRunner, frontend: Type[Frontend], captcha_solver: Type[CaptchaSolver], sessions: SessionPool = None,
+                 limiter: RateLimiter = None, links_lock: threading.Lock = None, tor_pool: TorPool = None,
+                 link_workers: int = 0):
         """Initialize the Downloader.
 
            The TorRunner could be launched or not, the .launch() method will be called when needed.
            Also it is caller responsibility to call .stop() method on the TorRunner.
+           HTTP connections are kept in given SessionPool (own one when not given) for all downloads.
+           Bandwidth of all downloads is limited by given RateLimiter (could be shared with other downloaders).
+           Downloaders running concurrently with the same Tor and CAPTCHA solver share the links_lock,
+           so that links of all of them are solved one at a time.
+           With TorPool (tor is then its main instance) links are solved over its Tor instances.
+           Links are solved by link_workers concurrent workers (0 = one for each Tor instance), so that
+           network waits of CAPTCHA attempts overlap; workers share Tor instances round-robin.
         """
 
         self.success = None
@@ -48,6 +105,7 @@ class Downloader:
         self.filename = None
         self.output_filename = None
         self.stat_filename = None
+        self.hash_filename = None
         self.total_size = None
         self.frontend = frontend
         self.log = frontend.main_log
@@ -56,6 +114,21 @@ class Downloader:
         self.cli_initialized = False
         self.conn_timeout = None
         self.tor = tor
+        self.parts_lock = threading.Lock()
+        self.links_cond = threading.Condition(self.parts_lock)
+        self.links_lock = links_lock if links_lock is not None else threading.Lock()
+        self.tor_pool = tor_pool
+        self.link_workers = link_workers or (len(tor_pool) if tor_pool is not None else 1)
+        self.sessions = sessions if sessions is not None else SessionPool()
+        # statistics of a shared pool would include connections of other downloads
+        self.own_sessions = sessions is None
+        self.limiter = limiter
+        self.captcha_solver.session = self.sessions.session
+
+    def cancel(self):
+        """Terminate the download, also when it has not started yet (it stops right at its start)"""
+        self.cancelled = True
+        self.terminate()
 
     def terminate(self, quiet: bool = False):
         if self.terminating:
@@ -67,11 +140,20 @@ class Downloader:
 
         self.stop_download.set()
         self.stop_captcha.set()
+        self._close_probe()
         if self.captcha_thread and self.captcha_thread.is_alive():
             self.captcha_thread.join()
-        for p in self.threads:
+        if self.file_data is not None:
+            # parts waiting for the output stream would never finish
+            self.file_data.interrupt("Download terminated")
+        with self.parts_lock:
+            # no new part threads are started after stop_download is set
+            threads = list(self.threads)
+        for p in threads:
             if p.is_alive():
                 p.join()
+        if self.file_data is not None:
+            self.file_data.close()
 
         if not quiet:
             self.log('Download terminated.', level=LogLevel.WARNING)
@@ -81,11 +163,21 @@ class Downloader:
             self.frontend_thread.join()
 
     def clean(self):
-        # remove resume .udown file
-        if os.path.exists(self.stat_filename):
-            os.remove(self.stat_filename)
+        # remove resume .udown file (and digests of blocks)
+        for filename in (self.stat_filename, self.hash_filename):
+            if filename is not None and os.path.exists(filename):
+                os.remove(filename)
         if self.page.linkCache is not None:
-            self.page.linkCache.delete_cache_file()
+            self.page.linkCache.delete_links()
+
+    def _check_free_space(self, size: int):
+        """Fail fast when the output file of given size would not fit on the disk"""
+        needed = missing_space(self.output_filename, size)
+        free = shutil.disk_usage(os.path.dirname(os.path.abspath(self.output_filename))).free
+        if needed > free:
+            raise DownloaderError(
+                f"Not enough free space for '{self.output_filename}': "
+                f"{round(needed / 1024**2, 2)} MB needed, only {round(free / 1024**2, 2)} MB available")
 
     def _captcha_breaker(self, page, parts):
         msg = ""
@@ -95,78 +187,288 @@ class Downloader:
             msg = "Solve CAPTCHA dlink .."
 
         try:
-            for url in self.captcha_download_links_generator:
-                if self.stop_captcha.is_set():
+            while not self.stop_captcha.is_set():
+                url = self._next_link(self.captcha_download_links_generator)
+                if url is None or self.stop_captcha.is_set():
                     break
                 self.captcha_solver.log(msg)
                 self.download_url_queue.put(url)
         except DownloaderError as e:
             self.captcha_solver.log(str(e), level=LogLevel.ERROR)
 
+    @contextmanager
+    def lease_tor(self) -> Iterator[TorRunner]:
+        """Exclusive use of a Tor instance for getting a link: leased from the pool (shared with concurrent
+        downloaders), or the only Tor under the links_lock"""
+        if self.tor_pool is not None:
+            with self.tor_pool.lease() as tor:
+                yield tor
+        else:
+            with self.links_lock:
+                yield self.tor
+
+    def _parallel_links(self) -> bool:
+        return self.link_workers > 1
+
+    def _worker_tor(self, index: int) -> TorRunner:
+        """Launched Tor instance of the link worker of given index"""
+        if self.tor_pool is not None:
+            return self.tor_pool.get(index)
+        self.tor.launch()
+        return self.tor
+
+    def _next_link(self, generator) -> Optional[str]:
+        """Returns the next link of the generator (None at its end)"""
+        return next(generator, None)
+
+    def _serial_links_generator(self, page: Page) -> Iterator[str]:
+        """Generator of download links solved one at a time: cached links first, then each attempt
+        over a Tor instance leased for it, while the parts need more links"""
+        obtained = 0
+        for link in page.cached_download_links():
+            obtained += 1
+            yield link
+        while obtained + page.alreadyDownloaded < self.parts and not self.stop_captcha.is_set():
+            with self.lease_tor() as tor:
+                link = page.download_link_attempt(self.captcha_solver, self.stop_captcha, tor)
+            if link is not None:
+                obtained += 1
+                yield link
+
+    def _links_generator(self, page: Page) -> Iterator[str]:
+        """Generator of download links solved in parallel: cached links first, then links of
+        `link_workers` workers while the parts need more links"""
+        with self.parts_lock:
+            self.links_obtained = 0
+            self.links_solving = 0
+            # all parts of a new download need links, those of a resumed one are known when it is loaded
+            resumed = self.stat_filename is not None and os.path.exists(self.stat_filename)
+            self.links_needed = None if resumed else self.parts
+        for link in page.cached_download_links():
+            with self.parts_lock:
+                self.links_obtained += 1
+            yield link
+
+        links = Queue()
+        workers = [threading.Thread(target=self._link_worker, args=(page, links, i), daemon=True)
+                   for i in range(self.link_workers)]
+        for w in workers:
+            w.start()
+        running = len(workers)
+        while running:
+            link = links.get()
+            if link is None:
+                running -= 1
+            else:
+                yield link
+
+    def _link_worker(self, page: Page, links: Queue, index: int):
+        """Solve links over the Tor instance of the worker, an attempt is started only when the links
+        already got and attempts in progress of all workers do not cover all parts (no link is solved in vain)"""
+        try:
+            tor = self._worker_tor(index)
+            while not self.stop_captcha.is_set():
+                with self.links_cond:
+                    # links needed by a resumed download are known when it is loaded (after the first link)
+                    while self.links_needed is None and self.links_obtained + self.links_solving >= 1 \
+                            and not self.stop_captcha.is_set():
+                        self.links_cond.wait(1)
+                    needed = self.links_needed if self.links_needed is not None else 1
+                    if self.links_obtained + self.links_solving >= needed:
+                        return
+                    self.links_solving += 1
+                link = None
+                try:
+                    link = page.download_link_attempt(self.captcha_solver, self.stop_captcha, tor)
+                finally:
+                    with self.parts_lock:
+                        self.links_solving -= 1
+                        if link is not None:
+                            self.links_obtained += 1
+                if link is not None:
+                    links.put(link)
+        except Exception as e:
+            self.captcha_solver.log(f"Link worker failed: {e}", level=LogLevel.ERROR)
+        finally:
+            links.put(None)
+
+    def _fresh_link(self, failed_url: str) -> Optional[str]:
+        """Returns a download link replacing the expired or blocked one, None when no link could be got.
+
+        A spare link from the queue is preferred, otherwise a new link is got (blocking).
+        """
+        download_url = self._get_spare_link()
+        if download_url is not None:
+            return download_url
+        return self._solve_fresh_link(failed_url)
+
+    def _solve_fresh_link(self, failed_url: str) -> Optional[str]:
+        """Get a new download link: the page is loaded again for the quick download link (shared by all parts),
+        or a new slow download link is solved (CAPTCHA or direct), blocking.
+        """
+        try:
+            if not self.isLimited:
+                with self.links_lock:
+                    if self.stop_download.is_set():
+                        return None
+                    if self.reusable_url != failed_url:
+                        return self.reusable_url  # already replaced for another part
+                    self.log("Quick download link failed, loading the page again for a new one", level=LogLevel.WARNING)
+                    page = Page(url=self.page.url, temp_dir=self.page.temp_dir, parts=self.parts, password=self.page.password,
+                                frontend=self.frontend, tor=self.tor, enforce_tor=self.enforce_tor, conn_timeout=self.conn_timeout)
+                    page.parse()
+                    if page.quickDownloadURL is None:
+                        raise DownloaderError("quick download is not available anymore")
+                    self.reusable_url = page.quickDownloadURL
+                    return self.reusable_url
+
+            self.log("Download link expired or blocked, solving a new one", level=LogLevel.WARNING)
+            # one attempt per lease, so the Tor instance is free for links of other parts in between
+            while not self.stop_download.is_set():
+                with self.lease_tor() as tor:
+                    link = self.page.download_link_attempt(self.captcha_solver, self.stop_download, tor)
+                if link is not None:
+                    return link
+            return None
+        except Exception as e:
+            self.log(f"Cannot get a new download link: {e}", level=LogLevel.ERROR)
+            return None
+
     def _download_part(self, part: DownloadPart):
         try:
-            self._download_part_internal(part)
+            try:
+                self._download_part_retrying(part)
+            finally:
+                # persist written position also on error or terminate (for resume)
+                part.writer.close()
+                part.buffer.release()
         except Exception as e:
             part.exception = e
             part.set_status(f"Error: {e}", error=True)
 
+    def _download_part_retrying(self, part: DownloadPart):
+        """Download given part, failed attempts are retried from the written offset with exponential backoff.
+
+        Failed attempts are counted only while the part makes no progress, the part
+        fails after PART_RETRIES of them in a row. Expired or blocked download link
+        is replaced by a fresh one before the next attempt.
+        """
+        attempt = 0
+        while True:
+            written = part.writer.written
+            try:
+                self._download_part_internal(part)
+                return
+            except PartError as e:
+                error = e
+            except NETWORK_ERRORS as e:
+                error = PartError(f"Connection error: {e!r}")
+            if self.stop_download.is_set():
+                return
+
+            attempt = 1 if part.writer.written > written else attempt + 1
+            if attempt > PART_RETRIES:
+                raise error
+            delay = backoff_delay(attempt, RETRY_BACKOFF, RETRY_BACKOFF_MAX)
+            part.set_status(f"{error}, retry {attempt}/{PART_RETRIES} in {round(delay, 1)} s", warning=True)
+            if self.stop_download.wait(delay):
+                return
+            if error.link_failed:
+                part.set_status("Waiting for a new download link…", warning=True)
+                download_url = self._fresh_link(part.download_url)
+                if download_url is None:
+                    raise error
+                part.download_url = download_url
+
     def _download_part_internal(self, part: DownloadPart):
-        """Download given part of the download.
+        """Download given part of the download (one attempt from the written offset).
 
             Arguments:
                 part (DownloadPart): Specification of the part to download
+
+            Raises:
+                PartError: On failed attempt which could be retried
         """
 
         writer = part.writer
 
         part.lock.acquire()
-        part.started = True
-        part.start_time = time.time()
+        if not part.started:
+            part.started = True
+            part.start_time = time.time()
         part.lock.release()
 
-        while True:
+        # the part at the start of the file continues the response of the size probe
+        r = self._take_probe(part)
+        while r is None:
             if self.stop_download.is_set():
                 return
 
             part.set_status("Starting download")
             # Note the stream=True parameter
-            r = requests.get(part.download_url, stream=True, allow_redirects=True, headers={
+            r = self.sessions.session.get(part.download_url, stream=True, allow_redirects=True, timeout=self.conn_timeout, headers={
                 "Range": "bytes={}-{}".format(writer.pfrom + writer.written, writer.pto),
-                "Connection": "close",
             })
+            if r.status_code in (429, 425):
+                # read the short error page, so the connection could be reused by the next attempt
+                r.content
+                release(r)
+                with self.parts_lock:
+                    self.throttled += 1
 
             if r.status_code == 429:
                 part.set_status("Status code 429 Too Many Requests returned… will try again in few seconds", warning=True)
                 time.sleep(5)
+                r = None
             elif r.status_code == 425:
                 part.set_status("Status code 425 Too Early returned… will try again in few seconds", warning=True)
                 time.sleep(5)
-            else:
-                break
+                r = None
 
         if r.status_code != 206 and r.status_code != 200:
-            part.set_status(f"Status code {r.status_code} returned: {writer.pfrom + writer.written}/{writer.pto}", error=True)
-            return
+            release(r)
+            raise PartError(f"Status code {r.status_code} returned: {writer.pfrom + writer.written}/{writer.pto}",
+                            link_failed=r.status_code in LINK_ERROR_CODES)
 
         part.set_status("")
+        self._first_byte()
 
-        # reimplement as multisegment write file class
-        for chunk in r.iter_content(chunk_size=DOWN_CHUNK_SIZE):
+        limiter, bucket = self.limiter, self.bucket
+        if 'Content-Encoding' not in r.headers:
+            # raw (not decoded) stream is read directly into the reusable buffer of the part
+            read_size = None if limiter is None else lambda: limiter.read_size(bucket)
+            chunks = part.buffer.chunks(r.raw, read_size)
+        else:
+            chunks = r.iter_content(chunk_size=DOWN_CHUNK_SIZE)
+
+        for chunk in chunks:
             if chunk:  # filter out keep-alive new chunks
-                writer.write(chunk)
+                wrt = writer.write(chunk)
 
                 part.lock.acquire()
-                part.d_now += len(chunk)
-                part.d_total += len(chunk)
+                part.d_now += wrt
+                part.d_total += wrt
                 part.lock.release()
 
+                if limiter is not None:
+                    delay = limiter.consume(bucket, wrt)
+                    if delay > 0:
+                        self.stop_download.wait(delay)
+
+                if writer.remaining() == 0:
+                    # end of the part (could be shortened by split meanwhile)
+                    break
+
                 if self.stop_download.is_set():
                     # TODO: cancel the request when urllib3/requests will be able to do so
                     # (now r.close() would be blocking until all chunks downloaded)
                     return
 
         # download end status
-        r.close()
+        release(r)
+        if writer.remaining() > 0:
+            raise PartError(f"Connection closed before the end of the part: {writer.pfrom + writer.written}/{writer.pto}")
+
         part.lock.acquire()
         part.completed = True
         part.completion_time = time.time()
@@ -175,57 +477,400 @@ class Downloader:
         # close part file files
         writer.close()
 
-        # reuse download link if need
-        self.download_url_queue.put(part.download_url)
+    def _probe_size(self, download_url: str) -> int:
+        """Returns size of the file from the first ranged GET of the whole file (instead of HEAD).
+
+        The response is kept as the probe and continued by the part starting at the
+        beginning of the file, so no request is spent only to learn the size.
+        HEAD is used when the response does not tell the size.
+        """
+        r = self.sessions.session.get(download_url, stream=True, allow_redirects=True, timeout=self.conn_timeout,
+                                      headers={"Range": "bytes=0-"})
+        size = None
+        if r.status_code == 206:
+            size = content_range_size(r.headers.get('Content-Range', ''))
+        elif r.status_code == 200 and 'Content-Length' in r.headers and 'Content-Encoding' not in r.headers:
+            size = int(r.headers['Content-Length'])
+        if size is None:
+            r.close()
+            head = self.sessions.session.head(download_url, allow_redirects=True)
+            return int(head.headers['Content-Length'])
+
+        self._first_byte()
+        with self.parts_lock:
+            self.probe = r
+        return size
+
+    def _take_probe(self, part: DownloadPart) -> Optional[requests.Response]:
+        """Returns the response of the size probe when the part continues from the start of the file (only once)"""
+        with self.parts_lock:
+            if self.probe is None or part.writer.pfrom + part.writer.written != 0:
+                return None
+            (r, self.probe) = (self.probe, None)
+            return r
+
+    def _close_probe(self):
+        """Close the response of the size probe when it was not taken by any part"""
+        with self.parts_lock:
+            (r, self.probe) = (self.probe, None)
+        if r is not None:
+            r.close()
+
+    def _first_byte(self):
+        """Record and log time to the first byte of the download (called on each response with data)"""
+        if self.ttfb is not None:
+            return
+        with self.parts_lock:
+            if self.ttfb is not None:
+                return
+            self.ttfb = time.time() - self.download_start
+        self.log(f"Time to first byte: {round(self.ttfb, 2)} s")
+
+    def _download_worker(self, part: DownloadPart):
+        """Download given part and then next parts one after another with the same download link"""
+        while True:
+            self._download_part(part)
+            if not part.completed:
+                return
+            with self.parts_lock:
+                if self.stop_download.is_set():
+                    return
+                next_part = None if self._over_limit() else self._take_next_part()
+                if next_part is None:
+                    self._put_link(part.download_url)
+                    return
+                next_part.download_url = part.download_url
+            part = next_part
+
+    def _start_part(self, part: DownloadPart, download_url: str):
+        """Start a worker thread downloading the part (and next parts), must be called with parts_lock held"""
+        if self.stop_download.is_set():
+            return
+        part.download_url = download_url
+        t = threading.Thread(target=self._download_worker, args=(part,))
+        self.threads.append(t)
+        t.start()
+
+    def _split_largest_part(self) -> Optional[DownloadPart]:
+        """Split the rest of the running part with the most remaining bytes, must be called with parts_lock held.
+
+            Returns:
+                DownloadPart: new part for the second half of the rest or None if there is nothing to split
+        """
+        running = [p for p in self.downloads if p.started and not p.completed and not p.error]
+        if not running:
+            return None
+        largest = max(running, key=lambda p: p.writer.remaining())
+        return self._split_part(largest, MIN_SPLIT_SIZE)
+
+    def _split_part(self, part: DownloadPart, min_size: int, keep: float = 0.5) -> Optional[DownloadPart]:
+        """Split the rest of given running part (see SegFileLoader.split), must be called with parts_lock held"""
+        writer = self.file_data.split(part.writer, min_size, keep)
+        if writer is None:
+            return None
+
+        part.lock.acquire()
+        part.size = part.writer.size
+        part.lock.release()
+
+        new_part = DownloadPart(writer)
+        new_part.set_status(f"Split from part {part.id}")
+        self.downloads.append(new_part)
+        return new_part
+
+    def _running_parts(self) -> int:
+        """Number of parts with a download link not finished yet, must be called with parts_lock held"""
+        return sum(1 for p in self.downloads if p.download_url is not None and not p.completed and not p.error)
+
+    def _over_limit(self) -> bool:
+        """True when the adaptive limit does not allow another running part, must be called with parts_lock held"""
+        return self.concurrency is not None and self._running_parts() >= self.concurrency.limit
+
+    def _adapt_concurrency(self):
+        """Update the adaptive limit of parallel parts from the throughput (called periodically).
+
+        Over the limit, links of completed parts are parked in the queue instead
+        of being handed over. Under the limit, new parts are started with a spare
+        link or with the reusable link of a quick download.
+        """
+        if self.concurrency is None:
+            return
+        with self.parts_lock:
+            if self.stop_download.is_set():
+                return
+            downloaded = sum(p.d_now for p in self.downloads)
+            self.concurrency.update(time.time(), downloaded, self.throttled, self._running_parts())
+            while not self._over_limit():
+                download_url = self._get_spare_link()
+                spare = download_url is not None
+                if not spare:
+                    download_url = self.reusable_url
+                    if download_url is None:
+                        return
+                part = self._take_next_part()
+                if part is None:
+                    if spare:
+                        self._put_link(download_url)
+                    return
+                self._start_part(part, download_url)
+
+    def _monitor(self):
+        """Periodic check of running parts while waiting for them"""
+        if self.limiter is not None:
+            self.limiter.poll()
+        self._adapt_concurrency()
+        self._dispatch_stragglers()
+
+    def progress(self) -> Tuple[int, float]:
+        """Returns remaining bytes and current speed (bytes per second) of the running download"""
+        now = time.time()
+        with self.parts_lock:
+            downloads = list(self.downloads)
+        remaining = sum(p.writer.remaining() for p in downloads if not p.completed)
+        speed = sum(p.speed(now) for p in downloads if p.started and not p.completed and not p.error)
+        return remaining, speed
+
+    def _get_spare_link(self) -> Optional[str]:
+        """Returns unused download link from the queue (without waiting) or None"""
+        try:
+            return self.download_url_queue.get_nowait()
+        except Empty:
+            return None
+
+    def _dispatch_stragglers(self):
+        """Give the tail of parts far behind the others to spare download links (called periodically).
+
+        Remaining time of running parts is estimated from their speed, each spare
+        link (returned to the queue when there was nothing left to split) counts
+        as a worker with nothing remaining. Part whose remaining time exceeds the
+        median more than straggler_factor times keeps only the share it downloads
+        in the time a spare link (expected as fast as the median part) needs for the
+        rest, the rest goes to a new part with the spare link. No byte is downloaded
+        twice, the straggler stops at the new end of its segment.
+        """
+        if not self.straggler_factor:
+            return
+        with self.parts_lock:
+            spare = self.download_url_queue.qsize()
+            if self.stop_download.is_set() or self.pending_parts or spare == 0 or self._over_limit():
+                return
+
+            now = time.time()
+            speeds = [p.speed(now) for p in self.downloads
+                      if p.started and not p.error and (p.completed or now - p.start_time >= STRAGGLER_MIN_TIME)]
+            running = {}
+            for p in self.downloads:
+                if p.started and not p.completed and not p.error and now - p.start_time >= STRAGGLER_MIN_TIME:
+                    speed = p.speed(now)
+                    if speed > 0:
+                        running[p] = (p.writer.remaining() / speed, speed)
+            if not running:
+                return
+
+            median_time = statistics.median([t for (t, _) in running.values()] + [0] * spare)
+            ref_speed = statistics.median(speeds)
+            stragglers = sorted(((t, speed, p) for (p, (t, speed)) in running.items()
+                                 if t > self.straggler_factor * median_time and t > STRAGGLER_MIN_TIME),
+                                key=lambda x: x[0], reverse=True)
+            for (remaining_time, speed, straggler) in stragglers:
+                if self._over_limit():
+                    break
+                download_url = self._get_spare_link()
+                if download_url is None:
+                    break
+                part = self._split_part(straggler, STRAGGLER_MIN_SPLIT, keep=speed / (speed + ref_speed))
+                if part is None:
+                    self._put_link(download_url)
+                    continue
+                self.log(f"Part {straggler.id} is too slow ({round(speed / 1024, 2)} KB/s, {round(remaining_time)} s remaining), "
+                         f"its tail is downloaded by another link", level=LogLevel.WARNING)
+                part.set_status(f"Tail of slow part {straggler.id}")
+                self._start_part(part, download_url)
+
+    def _take_next_part(self) -> Optional[DownloadPart]:
+        """Returns the next part for a free download link, must be called with parts_lock held.
+
+        The first part waiting for a link (in the file order) is preferred, otherwise
+        a new part is made by split of the largest running part.
+        """
+        if self.pending_parts:
+            return self.pending_parts.pop(0)
+        return self._split_largest_part()
+
+    def _reuse_link(self, download_url: str):
+        """Hand the download link of the completed part over to another part.
+
+        The link goes to a part waiting for a link or to a new part made by split
+        of the largest running part, otherwise (or over the adaptive limit) it is
+        returned to the queue.
+        """
+        with self.parts_lock:
+            if self.stop_download.is_set():
+                return
+            part = None if self._over_limit() else self._take_next_part()
+            if part is None:
+                self._put_link(download_url)
+            else:
+                self._start_part(part, download_url)
+
+    def _put_link(self, download_url: str):
+        """Return unused download link to the queue of links"""
+        self.download_url_queue.put(download_url)
+
+    def _run_parts(self, unfinished: List[DownloadPart], download_url: str) -> bool:
+        """Start downloads of given parts (each in its own thread) and wait until all of them
+        (including parts started later and parts made by splits) finish.
+
+            Returns:
+                bool: False when terminated before all downloads were started
+        """
+        if not any(part.writer.pfrom + part.writer.written == 0 for part in unfinished):
+            # start of the file is downloaded already (resume), the response of the size probe would stay open
+            self._close_probe()
 
-    def download(self, url: str, parts: int = 10, password: str = "", target_dir: str = "", temp_dir: str = "", do_overwrite: bool = False, conn_timeout=DEFAULT_CONN_TIMEOUT, enforce_tor = False):
+        # Prepare queue for recycling download URLs
+        self.download_url_queue = Queue(maxsize=0)
+
+        # limited must use TOR and solve links or captcha
+        if self.isLimited:
+            # Reuse already solved links
+            self.download_url_queue.put(download_url)
+
+            # Start CAPTCHA breaker in separate process
+            self.captcha_thread = threading.Thread(
+                target=self._captcha_breaker, args=(self.page, self.parts)
+            )
+
+        cpb_started = False
+        for part in unfinished:
+            if self.terminating:
+                return False
+
+            if self.isLimited:
+                if not cpb_started:
+                    self.captcha_thread.start()
+                    cpb_started = True
+                part_url = self.download_url_queue.get()
+            else:
+                part_url = download_url
+
+            # Start download process in another process (parallel):
+            with self.parts_lock:
+                self._start_part(part, part_url)
+
+        # no need for another links (also a signal for the prefetch of next files)
+        self.stop_captcha.set()
+        if self.isLimited:
+            if self.isCaptcha:
+                self.captcha_solver.log("All downloads started, no need to solve another CAPTCHAs…")
+            else:
+                self.captcha_solver.log("All downloads started, no need to solve another direct links…")
+
+        # Wait for all downloads to finish (threads of split parts are added meanwhile)
+        i = 0
+        while True:
+            with self.parts_lock:
+                if i >= len(self.threads):
+                    break
+                t = self.threads[i]
+            while t.is_alive():
+                t.join(1)
+                self._monitor()
+            i += 1
+        return True
+
+    def download(self, url: str, parts: int = 10, password: str = "", target_dir: str = "", temp_dir: str = "", do_overwrite: bool = False, conn_timeout=DEFAULT_CONN_TIMEOUT, enforce_tor = False,
+                 checkpoint_policy: CheckpointPolicy = None, write_mode: str = WRITE_MODE_FILE, preallocate: bool = False,
+                 hash_mode: str = None, stream: BinaryIO = None, stream_buffer: int = STREAM_BUFFER, segment_size: int = 0,
+                 straggler_factor: float = STRAGGLER_FACTOR, adaptive: bool = False, page: Page = None):
         """Download file from Uloz.to using multiple parallel downloads.
             Arguments:
                 url: URL of the Uloz.to file to download
                 parts: Number of parts that will be downloaded in parallel (default: 10)
+                segment_size: Slice the file into segments of this size (0 = one segment for each part),
+                              segments are downloaded by `parts` workers one after another, each with its own link
                 target_dir: Directory where the download should be saved (default: current directory)
                 do_overwrite: Overwrite files without asking
                 temp_dir: Directory where temporary files will be created (default: current directory)
                 password: Optional password to access the Uloz.to file
+                checkpoint_policy: How often the progress of parts is persisted into the .udown file
+                write_mode: How the parts are written into the output file (see segfile.WRITE_MODES)
+                preallocate: Allocate all blocks of the output file before the download starts
+                hash_mode: Hash data while downloading and write manifest with digests (see segfile.HASH_MODES)
+                stream: Write the file in file order into this binary stream (e.g. stdout) instead of a file,
+                        target_dir, write_mode, preallocate and hash_mode are ignored and the download cannot be resumed
+                stream_buffer: Maximum of bytes waiting in memory for writing into the stream
+                straggler_factor: Give the tail of a part to a spare link when its remaining time exceeds
+                                  the median this many times (0 = never)
+                adaptive: Adapt the number of parallel parts (at most `parts`) to the throughput (see ConcurrencyController),
+                          quick downloads start with ADAPTIVE_START parts, files are sliced into ADAPTIVE_SEGMENT_SIZE
+                          segments (at most ADAPTIVE_MAX_SEGMENTS of them) when segment_size is not given
+                page: Already parsed page of the URL (see Prefetcher), its cached links are used first
         """
+        self.download_start = time.time()
+        self.ttfb = None
         self.url = url
         self.parts = parts
+        self.straggler_factor = straggler_factor
         self.conn_timeout = conn_timeout
         self.enforce_tor = enforce_tor
 
         self.threads = []
-        self.terminating = False
+        self.downloads = []
+        self.pending_parts = []
+        self.throttled = 0
+        self.reusable_url = None
+        self.bucket = self.limiter.download_bucket() if self.limiter is not None else None
+        self.concurrency = None
+        self.file_data = None
         self.isLimited = False
         self.isCaptcha = False
 
         self.stop_download = threading.Event()
         self.stop_captcha = threading.Event()
         self.stop_frontend = threading.Event()
+        # events of this download are ready (they are checked by other threads once not terminating)
+        self.terminating = False
+        if self.cancelled:
+            # cancelled before terminate() could stop anything
+            self.terminating = True
+            raise DownloaderStopped()
+
+        # one kept connection for each part (never shrunk, the pool could be shared with concurrent downloads)
+        if self.sessions.pool_size < parts:
+            self.sessions.resize(parts)
+        sessions_start = self.sessions.stats()
 
         # 1. Prepare downloads
         self.log("Starting downloading for url '{}'".format(url))
         # 1.1 Get all needed information
         self.log("Getting info (filename, filesize, …)")
 
-        try:
-            self.page = Page(
-                url=url,
-                temp_dir=temp_dir,
-                parts=parts,
-                password=password,
-                frontend=self.frontend,
-                tor=self.tor,
-                enforce_tor=self.enforce_tor,
-                conn_timeout=self.conn_timeout
-            )
-            page = self.page  # shortcut
-            page.parse()
-
-        except Exception as e:
-            raise DownloaderError('Cannot download file: ' + str(e))
+        if page is not None:
+            self.page = page
+        else:
+            try:
+                self.page = Page(
+                    url=url,
+                    temp_dir=temp_dir,
+                    parts=parts,
+                    password=password,
+                    frontend=self.frontend,
+                    tor=self.tor,
+                    enforce_tor=self.enforce_tor,
+                    conn_timeout=self.conn_timeout
+                )
+                page = self.page  # shortcut
+                page.parse()
+
+            except Exception as e:
+                raise DownloaderError('Cannot download file: ' + str(e))
 
         # Check of the target is a file or directory and construct the output path accordingly
-        if not os.path.isdir(target_dir) and target_dir[-1] != '/':
+        if stream is not None:
+            # nothing is saved on the disk, the name is only displayed
+            self.output_filename = page.filename
+        elif not os.path.isdir(target_dir) and target_dir[-1] != '/':
             # Path to a file has been provided
             self.output_filename = target_dir
         else:
@@ -233,13 +878,19 @@ class Downloader:
             os.makedirs(target_dir, exist_ok = True)
             self.output_filename = os.path.join(target_dir, page.filename)
         self.filename = os.path.basename(self.output_filename)
-        self.stat_filename = os.path.join(temp_dir, self.filename + DOWNPOSTFIX)
-
-        self.log("Downloading into: '{}'".format(self.output_filename))
+        if stream is not None:
+            self.stat_filename = None
+            self.hash_filename = None
+            hash_mode = None
+            self.log("Downloading into the output stream in file order (cannot be resumed)")
+        else:
+            self.stat_filename = os.path.join(temp_dir, self.filename + DOWNPOSTFIX)
+            self.hash_filename = os.path.join(temp_dir, self.filename + HASHPOSTFIX)
+            self.log("Downloading into: '{}'".format(self.output_filename))
 
         # Do check - only if .udown status file not exists get question
         # .udown file is always present in cli_mode = False
-        if os.path.isfile(self.output_filename) and not os.path.isfile(self.stat_filename):
+        if stream is None and os.path.isfile(self.output_filename) and not os.path.isfile(self.stat_filename):
             if self.frontend.supports_prompt and not do_overwrite:
                 answer = self.frontend.prompt(
                     "WARNING: File '{}' already exists, overwrite it? [y/n] ".format(self.output_filename), level=LogLevel.WARNING)
@@ -249,6 +900,11 @@ class Downloader:
                 self.log("WARNING: File '{}' already exists, but .udown file not present. File will be overwritten.."
                          .format(self.output_filename), level=LogLevel.WARNING)
 
+        # When resuming the size is known already, check free space before any CAPTCHA is solved
+        resumed_size = stat_file_total_size(self.stat_filename) if stream is None else None
+        if resumed_size is not None:
+            self._check_free_space(resumed_size)
+
         info = DownloadInfo()
         info.filename = self.filename
         info.url = page.url
@@ -272,23 +928,52 @@ class Downloader:
             if self.isCaptcha and self.captcha_solver.cannot_solve:
                 raise DownloaderError("Cannot solve CAPTCHAs, no solver available. Terminating")
 
-            self.captcha_download_links_generator = page.captcha_download_links_generator(
-                solver=self.captcha_solver, stop_event=self.stop_captcha,
-            )
-            download_url = next(self.captcha_download_links_generator)
-
-        head = requests.head(download_url, allow_redirects=True)
-        self.total_size = int(head.headers['Content-Length'])
+            if self._parallel_links():
+                self.captcha_download_links_generator = self._links_generator(page)
+            else:
+                self.captcha_download_links_generator = self._serial_links_generator(page)
+            download_url = self._next_link(self.captcha_download_links_generator)
+            if download_url is None:
+                if self.terminating:
+                    raise DownloaderStopped()
+                raise DownloaderError("Cannot get any download link")
+
+        if adaptive:
+            # CAPTCHA links are solved for all parts at the start as usual (solving later would stall the ramp up),
+            # the limit only parks and resumes them
+            start = self.parts if self.isLimited else ADAPTIVE_START
+            self.concurrency = ConcurrencyController(start, self.parts, self.log)
+            self.log(f"Adaptive number of parallel parts: {self.concurrency.limit} at the start, at most {self.parts}")
+        if not self.isLimited:
+            self.reusable_url = download_url
+
+        if page.fileSize is not None:
+            self.total_size = page.fileSize
+        else:
+            self.total_size = self._probe_size(download_url)
+        if adaptive and not segment_size:
+            # parts stop only at segment ends
+            segment_size = max(ADAPTIVE_SEGMENT_SIZE, ceil(self.total_size / ADAPTIVE_MAX_SEGMENTS))
+        # Before the rest of links is solved
+        if stream is None:
+            self._check_free_space(self.total_size)
 
         try:
-            file_data = SegFileLoader(self.output_filename, self.stat_filename, self.total_size, parts)
+            if stream is not None:
+                file_data = StreamLoader(stream, self.total_size, parts, stream_buffer, checkpoint_policy, slug=page.slug,
+                                         segment_size=segment_size)
+            else:
+                file_data = SegFileLoader(self.output_filename, self.stat_filename, self.total_size, parts, checkpoint_policy,
+                                          write_mode, preallocate, slug=page.slug, log_func=self.log,
+                                          hash_file=self.hash_filename if hash_mode else None, segment_size=segment_size)
             writers = file_data.make_writers()
+            self.file_data = file_data
         except Exception as e:
             raise DownloaderError(f"Failed: Can not create '{self.output_filename}' error: {e} ")
 
         info.total_size = self.total_size
         info.part_size = file_data.part_size
-        info.parts = file_data.parts
+        info.parts = file_data.segments
 
         downloads: List[DownloadPart] = [DownloadPart(w) for w in writers]
 
@@ -308,61 +993,33 @@ class Downloader:
         )
         self.frontend_thread.start()
 
-        # Prepare queue for recycling download URLs
-        self.download_url_queue = Queue(maxsize=0)
-
-        # limited must use TOR and solve links or captcha
-        if self.isLimited:
-            # Reuse already solved links
-            self.download_url_queue.put(download_url)
-
-            # Start CAPTCHA breaker in separate process
-            self.captcha_thread = threading.Thread(
-                target=self._captcha_breaker, args=(page, self.parts)
-            )
-
-        cpb_started = False
-        page.alreadyDownloaded = 0
-
-        # 3. Start all downloads fill self.threads
+        # 3. Start all downloads (at most `parts` of them in parallel) and wait for them
+        unfinished = []
         for part in downloads:
-            if self.terminating:
-                return
-
-            if part.writer.written == part.writer.size:
+            if part.writer.remaining() == 0:
                 part.completed = True
                 part.set_status("Already downloaded from previous run, skipping")
-                page.alreadyDownloaded += 1
-                continue
-
-            if self.isLimited:
-                if not cpb_started:
-                    self.captcha_thread.start()
-                    cpb_started = True
-                part.download_url = self.download_url_queue.get()
             else:
-                part.download_url = download_url
-
-            # Start download process in another process (parallel):
-            t = threading.Thread(target=self._download_part, args=(part,))
-            t.start()
-            self.threads.append(t)
-
-        if self.isLimited:
-            # no need for another CAPTCHAs
-            self.stop_captcha.set()
-            if self.isCaptcha:
-                self.captcha_solver.log("All downloads started, no need to solve another CAPTCHAs…")
-            else:
-                self.captcha_solver.log("All downloads started, no need to solve another direct links…")
+                unfinished.append(part)
+
+        active = self.parts if self.concurrency is None else self.concurrency.limit
+        with self.parts_lock:
+            self.downloads = downloads
+            # the rest of parts (more segments than parts after splits in previous run) wait for a link
+            # handed over by completed part
+            self.pending_parts = unfinished[active:]
+        for part in self.pending_parts:
+            part.set_status("Waiting for free link…")
+        # links are needed only for parts started right now
+        page.alreadyDownloaded = self.parts - min(self.parts, len(unfinished))
+        with self.links_cond:
+            self.links_needed = self.parts - page.alreadyDownloaded
+            self.links_cond.notify_all()
+
+        if not self._run_parts(unfinished[:active], download_url):
+            return
 
-        # 4. Wait for all downloads to finish
-        success = True
-        for (t, part) in zip(self.threads, downloads):
-            while t.is_alive():
-                t.join(1)
-            if part.error:
-                success = False
+        success = all(part.completed and not part.error for part in self.downloads)
 
         self.terminate(quiet=True)
 
@@ -372,3 +1029,14 @@ class Downloader:
             raise DownloaderError("Failure of one or more downloads, exiting")
 
         self.log("All downloads successfully finished", level=LogLevel.SUCCESS)
+        if self.own_sessions and self.parts_use_sessions:
+            sessions_end = self.sessions.stats()
+            self.log("HTTP connections: {} opened for {} requests".format(
+                sessions_end["connections"] - sessions_start["connections"], sessions_end["requests"] - sessions_start["requests"]))
+
+        if hash_mode:
+            manifest_filename = self.output_filename + MANIFESTPOSTFIX
+            tree = file_data.write_manifest(manifest_filename, tree=hash_mode == HASH_MODE_TREE)
+            self.log("Digests of blocks written into '{}'".format(manifest_filename))
+            if tree is not None:
+                self.log("Tree digest (SHA-256 of block digests): {}".format(tree), level=LogLevel.SUCCESS)
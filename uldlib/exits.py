@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from .const import EXIT_BAD_SCORE, EXIT_EXCLUDE_MAX, EXIT_HALF_LIFE, EXIT_MIN_SCORE
+
+
+class ExitReputation:
+    """
+    Persistent reputation of Tor exit relays (by fingerprint) learned from attempts to get download links.
+
+    An exit gets a penalty for each attempt refused because of the download limit or a block and loses
+    it with a successful attempt. Penalties decay (halved each EXIT_HALF_LIFE seconds), so an exit is
+    avoided only while it is likely to be limited still. The scores are stored in a JSON file shared
+    by all Tor instances (and next runs), written atomically and merged with scores saved by other processes.
+    """
+    # fingerprint -> (score, timestamp of the score)
+    scores: Dict[str, Tuple[float, float]]
+
+    def __init__(self, filename: str):
+        """
+        Args:
+            filename (str): JSON file with the scores (created when missing).
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.scores = self._load()
+
+    def record(self, fingerprint: str, result: str) -> None:
+        """
+        Records the result of an attempt over the exit ("ok", "lim" or "block", other results are ignored).
+        """
+        if result not in ("ok", "lim", "block"):
+            return  # bad CAPTCHA or network errors say nothing about the exit
+        now = time.time()
+        with self.lock:
+            score = self._decay(*self.scores.get(fingerprint, (0, now)), now)
+            self.scores[fingerprint] = (0 if result == "ok" else score + 1, now)
+            self._save(now)
+
+    def bad_exits(self) -> List[str]:
+        """
+        Returns fingerprints of exits to avoid (the worst ones first, at most EXIT_EXCLUDE_MAX).
+        """
+        now = time.time()
+        with self.lock:
+            bad = [(self._decay(s, tm, now), fp) for (fp, (s, tm)) in self.scores.items()]
+        bad = sorted((s, fp) for (s, fp) in bad if s >= EXIT_BAD_SCORE)
+        return [fp for (_, fp) in reversed(bad)][:EXIT_EXCLUDE_MAX]
+
+    @staticmethod
+    def _decay(score: float, tm: float, now: float) -> float:
+        return score * 0.5 ** ((now - tm) / EXIT_HALF_LIFE)
+
+    def _load(self) -> Dict[str, Tuple[float, float]]:
+        try:
+            with open(self.filename, 'r') as f:
+                return {fp: (float(s), float(tm)) for (fp, (s, tm)) in json.load(f).items()}
+        except (OSError, ValueError, TypeError):
+            return {}  # missing or damaged, reputation is learned again
+
+    def _save(self, now: float) -> None:
+        # the latest score of each exit wins
+        scores = self._load()
+        for (fp, (s, tm)) in self.scores.items():
+            if fp not in scores or tm >= scores[fp][1]:
+                scores[fp] = (s, tm)
+        # forgotten exits are dropped, so the file does not grow with the history
+        # (recent successes are kept, older penalties of other processes must not override them)
+        self.scores = {fp: (s, tm) for (fp, (s, tm)) in scores.items()
+                       if self._decay(s, tm, now) >= EXIT_MIN_SCORE or now - tm < EXIT_HALF_LIFE}
+        tmp_file = f"{self.filename}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self.scores, f)
+            os.replace(tmp_file, self.filename)
+        except OSError:
+            pass  # kept in memory at least
@@ -11,7 +11,7 @@ import json
 from typing import Dict, List, Optional, Tuple
 
 from uldlib import utils
-from uldlib.const import CLI_STATUS_STARTLINE
+from uldlib.const import BATCH_PROGRESS_INTERVAL, CLI_STATUS_STARTLINE
 from uldlib.part import DownloadPart
 from uldlib.utils import LogLevel, Status
 
@@ -146,7 +146,7 @@ class ConsoleFrontend(Frontend):
             self._loop(info, parts, stop_event)
         except Exception:
             if self.cli_initialized:
-                y = info.parts + CLI_STATUS_STARTLINE + 4
+                y = len(parts) + CLI_STATUS_STARTLINE + 4
                 sys.stdout.write("\033[{};{}H".format(y, 0))
                 sys.stdout.write("\033[?25h")  # show cursor
                 self.cli_initialized = False
@@ -250,7 +250,7 @@ class ConsoleFrontend(Frontend):
             time.sleep(0.5)
 
         if self.cli_initialized:
-            y = info.parts + CLI_STATUS_STARTLINE + 4
+            y = len(parts) + CLI_STATUS_STARTLINE + 4
             sys.stdout.write("\033[{};{}H".format(y + 2, 0))
             sys.stdout.write("\033[?25h")  # show cursor
             self.cli_initialized = False
@@ -268,6 +268,75 @@ class ConsoleFrontend(Frontend):
         ))
 
 
+class FileFrontend(Frontend):
+    """Frontend of one of the files downloaded concurrently (batch mode).
+
+    Messages go to the shared frontend prefixed by the file name, progress of
+    the file is logged every `interval` seconds instead of the status panel.
+    Prompts of all files are serialized by the shared lock.
+    """
+    parent: Frontend
+    name: str
+
+    def __init__(self, parent: Frontend, name: str, prompt_lock: threading.Lock, interval: float = BATCH_PROGRESS_INTERVAL,
+                 supports_prompt: bool = True):
+        super().__init__(supports_prompt=supports_prompt and parent.supports_prompt)
+        self.parent = parent
+        self.name = name
+        self.prompt_lock = prompt_lock
+        self.interval = interval
+
+    def tor_log(self, msg: str, level: LogLevel = LogLevel.INFO, progress: bool = False):
+        self.parent.tor_log(msg, level=level, progress=progress)
+
+    def captcha_log(self, msg: str, level: LogLevel = LogLevel.INFO, progress: bool = False):
+        self.parent.captcha_log(f"[{self.name}] {msg}", level=level, progress=progress)
+
+    def main_log(self, msg: str, level: LogLevel = LogLevel.INFO, progress: bool = False):
+        self.parent.main_log(f"[{self.name}] {msg}", level=level, progress=progress)
+
+    def captcha_stats(self, stats: Dict[str, int]):
+        self.parent.captcha_stats(stats)
+
+    def prompt(self, msg: str, level: LogLevel = LogLevel.INFO) -> str:
+        with self.prompt_lock:
+            return self.parent.prompt(f"[{self.name}] {msg}", level=level)
+
+    def run(self, info: DownloadInfo, parts: List[DownloadPart], stop_event: threading.Event, terminate_func):
+        try:
+            self._loop(info, parts, stop_event)
+        except Exception:
+            print_exc()
+            terminate_func()
+
+    def _loop(self, info: DownloadInfo, parts: List[DownloadPart], stop_event: threading.Event):
+        self.name = info.filename
+
+        t_start = time.time()
+        s_start = sum(part.get_frontend_status()[2] for part in parts)
+        s_last, t_last = s_start, t_start
+
+        while not stop_event.wait(self.interval):
+            t = time.time()
+            s = sum(part.get_frontend_status()[2] for part in parts)
+            total_bps = (s - s_start) / (t - t_start)
+            now_bps = (s - s_last) / (t - t_last)
+            s_last, t_last = s, t
+            remaining = (info.total_size - s) / total_bps if total_bps > 0 else 0
+            percent = s / info.total_size * 100 if info.total_size else 100
+            self.main_log(
+                f"{(s / 1024 ** 2):.2f} MB ({percent:.2f} %)"
+                f", avg. speed: {(total_bps / 1024 ** 2):.2f} MB/s"
+                f", curr. speed: {(now_bps / 1024 ** 2):.2f} MB/s"
+                f", remaining: {timedelta(seconds=round(remaining))}")
+
+        elapsed = time.time() - t_start
+        s = sum(part.get_frontend_status()[2] for part in parts)
+        speed = (s - s_start) / elapsed if elapsed > 0 else 0
+        self.main_log("Downloaded {} MB in {} (average speed {} MB/s)".format(
+            round((s - s_start) / 1024**2, 2), str(timedelta(seconds=round(elapsed))), round(speed / 1024**2, 2)))
+
+
 class JSONFrontend(Frontend):
     show_parts: bool
     logfile: Optional[TextIOWrapper] = None
@@ -1,79 +1,124 @@
 import os
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
 from time import time
-from typing import List
+from typing import Iterator, List, Optional, Set
 from urllib.parse import parse_qs
 
-from .const import CACHEPOSTFIX
+from .const import CACHEPOSTFIX, LINKCACHE_DB, LINKCACHE_TIMEOUT
+
+_prepared_lock = threading.Lock()
+_prepared: Set[str] = set()  # databases created and compacted by this process
 
 
 class LinkCache:
     """
     A class for caching download links.
 
+    Links of all files are stored in one SQLite database in the temp directory, keyed by the file slug
+    and indexed by their expiration (the 'tm' query parameter), so the lookup does not depend on the
+    number of links cached in the past. SQLite makes the access of concurrent processes atomic,
+    duplicate links are stored once and expired links are deleted (compaction).
+    Links of a legacy text file `<filename>.ucache` are imported into the database.
+
     Attributes:
-        filename (str): The name of the file where the links will be stored.
+        db_file (str): The SQLite database with links of all files.
+        slug (str): Slug of the file.
         shorten_validity (int, optional): number of seconds of witch shorten the validity of given link.
 
     Methods:
-        delete_cache_file: Deletes the cache file if it exists.
+        delete_links: Deletes links of the file.
         add: Adds a new link to the cache.
         get_all_valid_links: Returns all valid links from the cache.
-        _is_link_valid: Determines whether a link is valid based on its timestamp query parameter.
-        _get_cache_content: Returns the content of the cache file.
+        expiration: Returns expiration timestamp of a link.
     """
 
-    def __init__(self, filename: str, shorten_validity: int = 5):
+    def __init__(self, temp_dir: str, slug: str, filename: str = None, shorten_validity: int = 5):
         """
         Initializes a new instance of the LinkCache class.
 
         Args:
-            filename (str): The name of the file where the links will be stored.
+            temp_dir (str): The directory where the database is stored.
+            slug (str): Slug of the file.
+            filename (str, optional): The file whose legacy .ucache file is imported (and removed).
             shorten_validity (int, optional): number of seconds of witch shorten the validity of given link.
         """
-        self.filename = filename
-        self.cache_file = self.filename + CACHEPOSTFIX
+        self.db_file = os.path.join(temp_dir, LINKCACHE_DB)
+        self.slug = slug
         self.shorten_validity = shorten_validity
+        self._prepare()
+        if filename is not None:
+            self._import_legacy(filename + CACHEPOSTFIX)
 
-    def delete_cache_file(self) -> None:
+    def delete_links(self) -> None:
         """
-        Deletes the cache file if it exists.
+        Deletes links of the file.
         """
-        if os.path.exists(self.cache_file):
-            os.remove(self.cache_file)
+        with self._connect() as db:
+            db.execute("DELETE FROM links WHERE slug = ?", (self.slug,))
 
     def add(self, link: str) -> None:
         """
-        Adds a new link to the cache.
+        Adds a new link to the cache (and deletes expired links of all files).
         """
-        with open(self.cache_file, 'a') as cache:
-            cache.write(f"{link}\n")
+        self._add_links([link])
 
     def get_all_valid_links(self) -> List[str]:
         """
         Returns all valid links from the cache.
         """
-        cache_content = self._get_cache_content()
-        return [link for link in cache_content if self._is_link_valid(link)]
+        # flag link as invalid {shorten_validity} second before it actually expires
+        with self._connect() as db:
+            rows = db.execute("SELECT link FROM links WHERE slug = ? AND tm > ? ORDER BY id",
+                              (self.slug, int(time()) + self.shorten_validity)).fetchall()
+        return [link for (link,) in rows]
 
-    def _is_link_valid(self, link: str) -> bool:
+    @staticmethod
+    def expiration(link: str) -> Optional[int]:
         """
-        Determines whether a link is valid based on its timestamp query parameter.
+        Returns expiration timestamp of a link (its 'tm' query parameter) or None if not present.
         """
         query_string = parse_qs(link, separator=';')
         if not query_string.get("tm"):
-            # link does not contain 'tm' query parameter
-            # therefore is not valid
-            return False
-        link_timestamp = int(query_string.get("tm")[0])
-        time_now = int(time())
-        # flag link as invalid {shorten_validity} second before it actually expires
-        return time_now < (link_timestamp - self.shorten_validity)
+            return None
+        return int(query_string.get("tm")[0])
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # a connection for each operation: links are added by concurrent link workers (threads)
+        with closing(sqlite3.connect(self.db_file, timeout=LINKCACHE_TIMEOUT)) as db:
+            with db:  # one transaction, committed or rolled back
+                yield db
+
+    def _add_links(self, links: List[str]) -> None:
+        # links without 'tm' query parameter are never valid
+        rows = [(self.slug, link.strip(), self.expiration(link.strip())) for link in links]
+        rows = [row for row in rows if row[2] is not None]
+        with self._connect() as db:
+            db.executemany("INSERT OR IGNORE INTO links (slug, link, tm) VALUES (?, ?, ?)", rows)
+            db.execute("DELETE FROM links WHERE tm <= ?", (int(time()),))
+
+    def _prepare(self) -> None:
+        """Create the database, expired links are deleted and the freed space is returned once per process"""
+        with _prepared_lock:
+            if self.db_file in _prepared:
+                return
+            with closing(sqlite3.connect(self.db_file, timeout=LINKCACHE_TIMEOUT, isolation_level=None)) as db:
+                db.execute("PRAGMA auto_vacuum = INCREMENTAL")  # effective only for a new database
+                db.execute("CREATE TABLE IF NOT EXISTS links ("
+                           "id INTEGER PRIMARY KEY, slug TEXT NOT NULL, link TEXT NOT NULL, tm INTEGER NOT NULL, "
+                           "UNIQUE (slug, link))")
+                db.execute("CREATE INDEX IF NOT EXISTS links_tm ON links (tm)")
+                db.execute("DELETE FROM links WHERE tm <= ?", (int(time()),))
+                # execute() runs only the first step of the pragma (freeing one page), the script runs it all
+                db.executescript("PRAGMA incremental_vacuum;")
+            _prepared.add(self.db_file)
+
+    def _import_legacy(self, cache_file: str) -> None:
+        if not os.path.exists(cache_file):
+            return
+        with open(cache_file, 'r') as cache:
+            self._add_links([link for link in cache.readlines() if link.strip()])
+        os.remove(cache_file)
 
-    def _get_cache_content(self) -> List[str]:
-        """
-        Returns the content of the cache file.
-        """
-        if not os.path.exists(self.cache_file):
-            return []
-        with open(self.cache_file, 'r') as cache:
-            return cache.readlines()
@@ -1,7 +1,7 @@
 import re
 import threading
 import time
-from typing import Optional, Type
+from typing import Dict, List, Optional, Type
 from urllib.parse import urlparse, urljoin
 from os import path
 import requests
@@ -27,6 +27,31 @@ def strip_tracking_info(url: str):
     return url.split("#!")[0] if "#!" in url else url
 
 
+class LinkStats:
+    """Statistics of attempts to get a download link, updated by concurrent link workers"""
+    counts: Dict[str, int]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"all": 0, "ok": 0, "bad": 0,
+                       "lim": 0, "block": 0, "net": 0}
+
+    def add(self, result: str = None):
+        """Count an attempt with given result ("ok", "bad", "lim", "block", "net" or None when unknown)"""
+        with self.lock:
+            self.counts["all"] += 1
+            if result is not None:
+                self.counts[result] += 1
+
+    def __getitem__(self, key: str) -> int:
+        with self.lock:
+            return self.counts[key]
+
+    def snapshot(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counts)
+
+
 class Page:
     url: str
     body: str
@@ -39,11 +64,12 @@ class Page:
     quickDownloadURL: str
     captchaURL: str
     isDirectDownload: bool
-    numTorLinks: int
     alreadyDownloaded: int
     password: str
 
     needPassword: bool = False
+    stats: LinkStats
+    fileSize: Optional[int] = None  # known before the download when the page was prefetched
 
     linkCache: Optional[LinkCache] = None
 
@@ -52,7 +78,7 @@ class Page:
 
             Arguments:
                 url (str): URL of the page with file
-                temp_dir (str): directory where .ucache file will be created
+                temp_dir (str): directory where the database of cached links will be created
                 parts (int): number of segments (parts)
                 password (str): password to access the Uloz.to file
                 frontend (Frontend): frontend object for password prompt (if supported)
@@ -92,8 +118,7 @@ class Page:
         self.pagename = parsed_url.hostname.capitalize()
         self.cli_initialized = False
         self.alreadyDownloaded = 0
-        self.stats = {"all": 0, "ok": 0, "bad": 0,
-                      "lim": 0, "block": 0, "net": 0}  # statistics
+        self.stats = LinkStats()
 
         s = requests.Session()
         if (self.enforce_tor):
@@ -190,13 +215,12 @@ class Page:
 
     # print TOR network error and += stats
     def _error_net_stat(self, err, log_func):
-        self.stats["all"] += 1
         log_func(f"Network error get new TOR connection: {err}", level=LogLevel.ERROR)
-        self.stats["net"] += 1
+        self.stats.add("net")
 
     def _link_validation_stat(self, resp, log_func):
         linkdata = resp.text
-        self.stats["all"] += 1
+        result = None
         ok = False
         reload = True
 
@@ -212,155 +236,149 @@ class Page:
         bcp_msg = "Bad captcha.. Try again using same IP"
 
         if good_str in linkdata:
-            self.stats["ok"] += 1
+            result = "ok"
             ok = True
         elif lim_str in linkdata:
-            self.stats["lim"] += 1
+            result = "lim"
             if not self.isDirectDownload:
                 log_func(lim_msg, level=LogLevel.ERROR)
         elif blk_str in linkdata:
-            self.stats["block"] += 1
+            result = "block"
             if not self.isDirectDownload:
                 log_func(blk_msg, level=LogLevel.ERROR)
         elif bcp_str in linkdata:
-            self.stats["bad"] += 1
+            result = "bad"
             log_func(bcp_msg, level=LogLevel.ERROR)
             reload = False  # bad captcha same IP again
 
-        return (ok, reload)
+        self.stats.add(result)
+        return (ok, reload, result)
+
+    def cached_download_links(self) -> List[str]:
+        """Returns valid links from the link cache of the file"""
+        self.linkCache = self._link_cache()
+        return self.linkCache.get_all_valid_links()
 
-    def captcha_download_links_generator(self, solver: Type[CaptchaSolver], stop_event: threading.Event = None):
+    def _link_cache(self) -> LinkCache:
+        return LinkCache(self.temp_dir, self.slug, filename=path.join(self.temp_dir, self.filename))
+
+    def download_link_attempt(self, solver: Type[CaptchaSolver], stop_event: threading.Event = None,
+                              tor: TorRunner = None) -> Optional[str]:
         """
-            Generator for CAPTCHA download links using Tor sessions.
-            Get download link by solving CAPTCHA, calls CAPTCHA related functions..
+            One attempt to get a download link (solving CAPTCHA when needed) over a Tor circuit of its own
+            (isolated by SOCKS credentials), the link is added into the link cache.
 
             Arguments:
                 solver (CaptchaSolver): Class with solve method which gets CAPTCHA challenge URL and returns CAPTCHA answer
                 stop_event: Threading event to check when to stop
+                tor: Tor instance used for the attempt (default: the Tor of the page)
 
             Returns:
-                str: URL for downloading the file
+                str: URL for downloading the file, None when the attempt failed
         """
-
-        self.numTorLinks = 0
-        self.cacheEmpty = False
-        self.linkCache = LinkCache(path.join(self.temp_dir, self.filename))
-
-        while not self.cacheEmpty:
-            cached = self.linkCache.get_all_valid_links()
-            self.cacheEmpty = True
-            for link in cached:
-                # linkCache.use(self.numTorLinks)
-                self.numTorLinks += 1
-                yield link
-
-        while (self.numTorLinks + self.alreadyDownloaded) < self.parts:
-            if stop_event and stop_event.is_set():
-                break
-
-            self.tor.launch()  # ensure that TOR is running
-
-            # reload tor after 1. use or all except badCaptcha case
-            reload = False
-            if self.stats["all"] > 0 or reload:
-                self.tor.reload()
-
-            try:
-                s = requests.Session()
-                if (self.enforce_tor):
-                    # In case TOR enforcing mode is on, use TOR also for the initial request
-                    s.proxies = self.tor.proxies
-
-                if urlparse(self.url).hostname == "pornfile.cz":
-                    r = s.post("https://pornfile.cz/porn-disclaimer/", data={
-                        "agree": "Souhlasím",
-                        "_do": "pornDisclaimer-submit",
-                    })
-
-                if self.needPassword:
-                    s.get(self.url)  # to obtain initial set of cookies
-                    s.post(self.url, data={
-                        "password": self.password,
-                        "password_send": "Odeslat",
-                        "_do": "passwordProtectedForm-submit",
-                    })
-
-                resp = requests.Response()
-
-                if self.isDirectDownload:
-                    solver.log(f"TOR get downlink (timeout {self.conn_timeout})")
-                    resp = s.get(self.captchaURL,
-                                 headers=XML_HEADERS, timeout=self.conn_timeout, proxies=self.tor.proxies if not self.enforce_tor else {})
-                else:
-                    solver.log(f"TOR get new CAPTCHA (timeout {self.conn_timeout})")
-                    r = s.get(self.captchaURL, headers=XML_HEADERS, proxies=self.tor.proxies if not self.enforce_tor else {})
-
-                    if r.status_code == 403:
-                        r = self.scraper.get(self.captchaURL, headers=XML_HEADERS, proxies=self.tor.proxies if not self.enforce_tor else {})
-
-                    # <img class="xapca-image" src="//xapca1.uloz.to/0fdc77841172eb6926bf57fe2e8a723226951197/image.jpg" alt="">
-                    captcha_image_url = parse_single(
-                        r.text, r'<img class="xapca-image" src="([^"]*)" alt="">')
-
-                    if captcha_image_url is None:
-                        solver.log("ERROR: Cannot parse CAPTCHA image URL from the page. Changing Tor circuit.", level=LogLevel.ERROR)
-                        self.stats["all"] += 1
-                        self.stats["net"] += 1
-                        solver.stats(self.stats)
-                        reload = True
-                        continue
-
-                    captcha_data = {}
-                    for name in ("_token_", "timestamp", "salt", "hash", "captcha_type", "_do"):
-                        captcha_data[name] = parse_single(r.text, r'name="' + re.escape(name) + r'" value="([^"]*)"')
-
-                    # https://github.com/setnicka/ulozto-downloader/issues/82
-                    captcha_image_url = urljoin("https:", captcha_image_url)
-
-                    solver.log("Image URL obtained, trying to solve")
-                    captcha_answer = solver.solve(captcha_image_url, stop_event)
-
-                    captcha_data["captcha_value"] = captcha_answer
-
-                    solver.log(f"CAPTCHA answer '{captcha_answer}' (timeout {self.conn_timeout})")
-
-                    resp = s.post(self.captchaURL, data=captcha_data,
-                                  headers=XML_HEADERS, timeout=self.conn_timeout)
-
-                    if resp.status_code == 403:
-                        resp = self.scraper.post(self.captchaURL, data=captcha_data,
-                                  headers=XML_HEADERS, timeout=self.conn_timeout)
-
-                # generate result or break
-                result = self._link_validation_stat(resp, solver.log)
-                solver.stats(self.stats)
-                # for noreload (bad captcha no need reload TOR)
-                reload = result[1]
-                if result[0]:
-                    dlink = resp.json()["slowDownloadLink"]
-                    # cache link here
-                    self.linkCache.add(dlink)
-                    self.numTorLinks += 1
-                    yield dlink
-                elif self.isDirectDownload:
-                    solver.log("Direct download does no seem to work, trying with captcha resolution instead...")
-                    self.isDirectDownload = False
-
-            except requests.exceptions.ConnectionError:
-                self._error_net_stat(
-                    "Connection error, try new TOR session.", solver.log)
-            except requests.exceptions.ChunkedEncodingError:
-                self._error_net_stat(
-                    "Error while communicating over Tor, try new TOR session", solver.log)
-            except requests.exceptions.ReadTimeout:
-                self._error_net_stat(
-                    "ReadTimeout error, try new TOR session.", solver.log)
-            except cloudscraper.exceptions.CloudflareChallengeError as e:
-                self._error_net_stat(
-                    f"Cloudflare scrapper error: {e}. Try new TOR session.", solver.log)
-                time.sleep(1)
-
-            solver.stats(self.stats)
+        tor = tor or self.tor
+        if self.linkCache is None:
+            self.linkCache = self._link_cache()
+
+        tor.launch()  # ensure that TOR is running
+        tor.exclude_bad_exits()
+        # new circuit for each attempt, concurrent attempts do not share exits
+        proxies = tor.isolated_proxies()
+
+        try:
+            s = requests.Session()
+            if (self.enforce_tor):
+                # In case TOR enforcing mode is on, use TOR also for the initial request
+                s.proxies = proxies
+
+            if urlparse(self.url).hostname == "pornfile.cz":
+                r = s.post("https://pornfile.cz/porn-disclaimer/", data={
+                    "agree": "Souhlasím",
+                    "_do": "pornDisclaimer-submit",
+                })
+
+            if self.needPassword:
+                s.get(self.url)  # to obtain initial set of cookies
+                s.post(self.url, data={
+                    "password": self.password,
+                    "password_send": "Odeslat",
+                    "_do": "passwordProtectedForm-submit",
+                })
+
+            resp = requests.Response()
+
+            if self.isDirectDownload:
+                solver.log(f"TOR get downlink (timeout {self.conn_timeout})")
+                resp = s.get(self.captchaURL,
+                             headers=XML_HEADERS, timeout=self.conn_timeout, proxies=proxies)
+            else:
+                solver.log(f"TOR get new CAPTCHA (timeout {self.conn_timeout})")
+                r = s.get(self.captchaURL, headers=XML_HEADERS, proxies=proxies)
+
+                if r.status_code == 403:
+                    r = self.scraper.get(self.captchaURL, headers=XML_HEADERS, proxies=proxies)
+
+                # <img class="xapca-image" src="//xapca1.uloz.to/0fdc77841172eb6926bf57fe2e8a723226951197/image.jpg" alt="">
+                captcha_image_url = parse_single(
+                    r.text, r'<img class="xapca-image" src="([^"]*)" alt="">')
+
+                if captcha_image_url is None:
+                    solver.log("ERROR: Cannot parse CAPTCHA image URL from the page. Changing Tor circuit.", level=LogLevel.ERROR)
+                    self.stats.add("net")
+                    solver.stats(self.stats.snapshot())
+                    return None
+
+                captcha_data = {}
+                for name in ("_token_", "timestamp", "salt", "hash", "captcha_type", "_do"):
+                    captcha_data[name] = parse_single(r.text, r'name="' + re.escape(name) + r'" value="([^"]*)"')
+
+                # https://github.com/setnicka/ulozto-downloader/issues/82
+                captcha_image_url = urljoin("https:", captcha_image_url)
+
+                solver.log("Image URL obtained, trying to solve")
+                captcha_answer = solver.solve(captcha_image_url, stop_event)
+
+                captcha_data["captcha_value"] = captcha_answer
+
+                solver.log(f"CAPTCHA answer '{captcha_answer}' (timeout {self.conn_timeout})")
+
+                resp = s.post(self.captchaURL, data=captcha_data,
+                              headers=XML_HEADERS, timeout=self.conn_timeout)
+
+                if resp.status_code == 403:
+                    resp = self.scraper.post(self.captchaURL, data=captcha_data,
+                              headers=XML_HEADERS, timeout=self.conn_timeout)
+
+            # generate result or break
+            result = self._link_validation_stat(resp, solver.log)
+            solver.stats(self.stats.snapshot())
+            if result[2] is not None:
+                tor.record_exit(proxies, result[2])
+            if result[0]:
+                dlink = resp.json()["slowDownloadLink"]
+                # cache link here
+                self.linkCache.add(dlink)
+                return dlink
+            elif self.isDirectDownload:
+                solver.log("Direct download does no seem to work, trying with captcha resolution instead...")
+                self.isDirectDownload = False
+
+        except requests.exceptions.ConnectionError:
+            self._error_net_stat(
+                "Connection error, try new TOR session.", solver.log)
+        except requests.exceptions.ChunkedEncodingError:
+            self._error_net_stat(
+                "Error while communicating over Tor, try new TOR session", solver.log)
+        except requests.exceptions.ReadTimeout:
+            self._error_net_stat(
+                "ReadTimeout error, try new TOR session.", solver.log)
+        except cloudscraper.exceptions.CloudflareChallengeError as e:
+            self._error_net_stat(
+                f"Cloudflare scrapper error: {e}. Try new TOR session.", solver.log)
+            time.sleep(1)
+
+        solver.stats(self.stats.snapshot())
+        return None
 
     def enter_password(self, session):
 
@@ -2,16 +2,71 @@ import threading
 import time
 
 from datetime import timedelta
-from typing import Tuple
+from typing import Callable, Iterator, Optional, Tuple
 
+from uldlib.const import DOWN_CHUNK_SIZE, RECV_BUFFER_MAX, RECV_BUFFER_TIME
 from uldlib.utils import LogLevel
 from uldlib.segfile import SegFileWriter
 
 
+class ReceiveBuffer:
+    """Reusable buffer for reading data of a part without allocation of each chunk.
+
+    Size of the chunks follows the rate of the part - doubled when a read is much
+    faster than RECV_BUFFER_TIME, halved when much slower - so that reads of
+    slow parts still return often enough and fast parts do not spin on small chunks.
+    """
+    buf: bytearray
+    size: int
+
+    def __init__(self, min_size: int = DOWN_CHUNK_SIZE, max_size: int = RECV_BUFFER_MAX):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = min_size
+        # allocated on the first read (parts waiting for a link do not hold any memory)
+        self.buf = bytearray()
+        self.view = memoryview(self.buf)
+
+    def chunks(self, fp, read_size: Optional[Callable[[], int]] = None) -> Iterator[memoryview]:
+        """Read fp (with readinto method) to the end, yields views of the buffer valid until the next chunk.
+
+            Arguments:
+                fp: file-like object with readinto method
+                read_size: returns the size of reads required by the rate limiter (0 = adapted to the rate of the part)
+        """
+        target = RECV_BUFFER_TIME / 1000
+        while True:
+            size = self.size
+            limit = read_size() if read_size is not None else 0
+            if limit:
+                # the same size for all limited parts, each part then gets the same share of the rate
+                size = min(limit, self.max_size)
+            if len(self.buf) < size:
+                # never resized in place - views of the old buffer could still exist
+                self.buf = bytearray(size)
+                self.view = memoryview(self.buf)
+            t = time.monotonic()
+            n = fp.readinto(self.view[:size])
+            if not n:
+                return
+            yield self.view[:n]
+
+            elapsed = time.monotonic() - t
+            if n == size == self.size and elapsed < target / 2:
+                self.size = min(self.size * 2, self.max_size)
+            elif elapsed > target * 2:
+                self.size = max(self.size // 2, self.min_size)
+
+    def release(self):
+        self.buf = bytearray()
+        self.view = memoryview(self.buf)
+
+
 class DownloadPart:
     id: int
     writer: SegFileWriter
-    download_url: str
+    download_url: str = None
+    buffer: ReceiveBuffer
 
     success: bool = False
     exception: Exception = None
@@ -33,6 +88,7 @@ class DownloadPart:
         self.writer = writer
         self.id = writer.id
         self.lock = threading.Lock()
+        self.buffer = ReceiveBuffer()
 
         # Init empty status
         self.started = False
@@ -50,6 +106,14 @@ class DownloadPart:
         self.warning = warning
         self.lock.release()
 
+    def speed(self, now: float) -> float:
+        """Returns average speed of the part (bytes per second) since its start"""
+        with self.lock:
+            if not self.started:
+                return 0
+            elapsed = (self.completion_time if self.completed else now) - self.start_time
+            return self.d_now / elapsed if elapsed > 0 else 0
+
     def get_frontend_status(self) -> Tuple[str, LogLevel, int]:
         """
         Returns status line for given part
@@ -0,0 +1,152 @@
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+from uldlib.captcha import CaptchaSolver
+from uldlib.const import PREFETCH_INTERVAL, PREFETCH_LINK_MARGIN, PREFETCH_LINK_VALIDITY
+from uldlib.downloader import Downloader
+from uldlib.linkcache import LinkCache
+from uldlib.page import Page
+from uldlib.utils import LogLevel
+
+PageFactory = Callable[[str], Page]
+
+
+class Prefetcher:
+    """Look-ahead stage of sequential downloads: while a file is downloaded, pages of
+    the next `depth` files are loaded and parsed and their download links are prepared.
+
+    Nothing is prepared until all parts of the current download are started (it needs no more
+    links). The size of a quick download is got by HEAD of its link right away. Slow download
+    links are solved into the LinkCache of the file, which its download reads first, one attempt
+    per lease of Tor (replacement links of the current download are not delayed). A link is
+    solved only when the file is expected to start before the link expires: the start is
+    estimated from the remaining bytes of the current download, sizes of files in between and
+    the current speed, validity of links is learned from the `tm` parameter of solved links.
+    """
+    depth: int
+    parts: int
+    link_validity: float
+
+    # Lock and protected variables
+    lock: threading.Lock
+    urls: List[str]
+    downloader: Optional[Downloader]
+    pages: Dict[str, Page]
+    failed: Set[str]
+
+    def __init__(self, depth: int, parts: int, page_factory: PageFactory, solver: CaptchaSolver, log_func: Callable):
+        """
+        Arguments:
+            depth: number of next files prepared
+            parts: number of parts of each file (links solved in advance at most)
+            page_factory: creates (not parsed) Page of given URL, must not prompt
+            solver: CAPTCHA solver shared with the downloads
+            log_func: logging function
+        """
+        self.depth = depth
+        self.parts = parts
+        self.page_factory = page_factory
+        self.solver = solver
+        self.log = log_func
+        self.link_validity = PREFETCH_LINK_VALIDITY
+        self.lock = threading.Lock()
+        self.urls = []
+        self.downloader = None
+        self.pages = {}
+        self.failed = set()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def follow(self, downloader: Downloader, urls: List[str]):
+        """Prepare files of `urls` (first `depth` of them) while `downloader` downloads the current file"""
+        with self.lock:
+            self.downloader = downloader
+            self.urls = urls[:self.depth]
+
+    def take(self, url: str) -> Optional[Page]:
+        """Returns parsed page of the URL when it was prefetched (only once), None otherwise"""
+        with self.lock:
+            return self.pages.pop(url, None)
+
+    def stop(self):
+        """Stop preparing (a page or link being loaded is finished in the background)"""
+        self.stop_event.set()
+
+    def _run(self):
+        while not self.stop_event.wait(PREFETCH_INTERVAL):
+            with self.lock:
+                urls = list(self.urls)
+                d = self.downloader
+            if d is not None and not d.terminating and d.stop_captcha.is_set():
+                try:
+                    self._prefetch(urls, d)
+                except Exception as e:
+                    self.log(f"Prefetch failed: {e}", level=LogLevel.WARNING)
+
+    def _prefetch(self, urls: List[str], d: Downloader):
+        (remaining, speed) = d.progress()
+        start = remaining / speed if speed else None  # expected start of the next file
+        for url in urls:
+            page = self._prepare_page(url, d)
+            if page is None or self.stop_event.is_set():
+                return
+            if page.slowDownloadURL is not None and page.quickDownloadURL is None and start is not None:
+                self._solve_link(page, start, d)
+            if start is None or page.fileSize is None:
+                return  # start of further files cannot be estimated
+            start += page.fileSize / speed
+
+    def _prepare_page(self, url: str, d: Downloader) -> Optional[Page]:
+        with self.lock:
+            if url in self.failed:
+                return None
+            page = self.pages.get(url)
+        if page is not None:
+            return page
+
+        try:
+            page = self.page_factory(url)
+            page.parse()
+            if page.quickDownloadURL is not None:
+                page.fileSize = self._head_size(page.quickDownloadURL, d)
+        except Exception as e:
+            self.log(f"Prefetch of '{url}' failed, it will be loaded at its start: {e}", level=LogLevel.WARNING)
+            with self.lock:
+                self.failed.add(url)
+            return None
+
+        self.log(f"Prefetched page of '{page.filename}'")
+        with self.lock:
+            self.pages[url] = page
+        return page
+
+    def _solve_link(self, page: Page, start: float, d: Downloader):
+        """Solve one more link of the page into its LinkCache when it is expected to be valid at the start of the file"""
+        if start + PREFETCH_LINK_MARGIN > self.link_validity:
+            return
+        if len(page.cached_download_links()) >= self.parts:
+            return
+        # a single attempt per lease, a failed one is repeated in the next pass
+        with d.lease_tor() as tor:
+            if d.terminating:
+                return
+            link = page.download_link_attempt(self.solver, self.stop_event, tor)
+        if link is None:
+            return
+
+        expiration = LinkCache.expiration(link)
+        if expiration is not None:
+            self.link_validity = expiration - time.time()
+        if page.fileSize is None:
+            try:
+                page.fileSize = self._head_size(link, d)
+            except Exception as e:
+                self.log(f"Cannot get size of '{page.filename}': {e}", level=LogLevel.WARNING)
+        self.log(f"Prefetched download link of '{page.filename}' (valid {round(self.link_validity)} s, "
+                 f"expected start in {round(start)} s)")
+
+    def _head_size(self, url: str, d: Downloader) -> int:
+        head = d.sessions.session.head(url, allow_redirects=True)
+        return int(head.headers['Content-Length'])
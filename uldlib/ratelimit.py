@@ -0,0 +1,161 @@
+import os
+import re
+import threading
+import time
+import weakref
+from typing import Callable, Optional
+
+from uldlib.const import DOWN_CHUNK_SIZE, RATE_LIMIT_BURST, RECV_BUFFER_TIME
+from uldlib.utils import LogLevel
+
+_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_rate(value: str) -> int:
+    """Parse rate in bytes per second with optional K, M or G suffix (e.g. '500K', '1.5M'), 0 = unlimited"""
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?)(?:i?B)?(?:/s)?\s*", value, re.IGNORECASE)
+    if not m:
+        raise ValueError(f"Invalid rate '{value}', expected e.g. 500K or 2M")
+    return int(float(m.group(1)) * _UNITS[m.group(2).upper()])
+
+
+def format_rate(rate: int) -> str:
+    return "unlimited" if not rate else f"{round(rate / 1024, 2)} KB/s"
+
+
+class TokenBucket:
+    """Token bucket allowing debt: a consumer takes tokens for received bytes and waits until the debt is paid.
+
+    Later consumers wait also for the debt of earlier ones, so concurrent
+    consumers are served in order of arrival and each gets its share of the
+    rate by bytes. At most RATE_LIMIT_BURST seconds of unused rate is saved.
+    """
+    rate: int
+
+    def __init__(self, rate: int = 0):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: int):
+        """Change the rate (bytes per second, 0 = unlimited), waiting consumers are not affected"""
+        with self.lock:
+            self.rate = rate
+            self.last = time.monotonic()
+            self.tokens = min(self.tokens, self._burst()) if rate else 0.0
+
+    def consume(self, n: int) -> float:
+        """Take n tokens, returns seconds to wait before receiving more data"""
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            rate = self.rate
+            if not rate:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.last) * rate, self._burst()) - n
+            self.last = now
+            return -self.tokens / rate if self.tokens < 0 else 0.0
+
+    def _burst(self) -> float:
+        return self.rate * RATE_LIMIT_BURST
+
+
+class RateLimiter:
+    """Bandwidth limit shared by all parts of all downloads (global) and by parts of each download.
+
+    Each part takes tokens from the global bucket and from the bucket of its
+    download after each chunk and sleeps for the longer of both waits. Limits
+    could be changed at runtime by the control file (see poll()).
+    """
+    bucket: TokenBucket
+    download_rate: int
+    control_file: Optional[str]
+
+    def __init__(self, rate: int = 0, download_rate: int = 0, control_file: str = None, log_func: Callable = None):
+        """
+        Arguments:
+            rate: global limit in bytes per second (0 = unlimited)
+            download_rate: limit of each download in bytes per second (0 = unlimited)
+            control_file: file with `rate-limit=RATE` and/or `download-rate-limit=RATE` lines
+                          (RATE as for parse_rate), checked for changes by poll()
+            log_func: logging function for limit changes
+        """
+        self.bucket = TokenBucket(rate)
+        self.download_rate = download_rate
+        self.control_file = control_file
+        self.control_mtime = None
+        self.log_func = log_func
+        self.lock = threading.Lock()
+        self.download_buckets = weakref.WeakSet()
+
+    def download_bucket(self) -> TokenBucket:
+        """New bucket for a download, following changes of the per-download limit"""
+        bucket = TokenBucket(self.download_rate)
+        with self.lock:
+            self.download_buckets.add(bucket)
+        return bucket
+
+    def consume(self, download_bucket: TokenBucket, n: int) -> float:
+        """Take tokens for n received bytes, returns seconds to wait"""
+        return max(self.bucket.consume(n), download_bucket.consume(n))
+
+    def read_size(self, download_bucket: TokenBucket) -> int:
+        """Size of reads of limited parts (0 = not limited), a chunk takes about RECV_BUFFER_TIME of the rate"""
+        rates = [r for r in (self.bucket.rate, download_bucket.rate) if r]
+        if not rates:
+            return 0
+        return max(DOWN_CHUNK_SIZE, min(rates) * RECV_BUFFER_TIME // 1000)
+
+    def set_limits(self, rate: int, download_rate: int):
+        if rate != self.bucket.rate:
+            self.bucket.set_rate(rate)
+        with self.lock:
+            self.download_rate = download_rate
+            buckets = list(self.download_buckets)
+        for bucket in buckets:
+            if download_rate != bucket.rate:
+                bucket.set_rate(download_rate)
+
+    def poll(self):
+        """Reload limits from the control file when it was changed (called periodically)"""
+        if self.control_file is None:
+            return
+        try:
+            mtime = os.stat(self.control_file).st_mtime
+        except OSError:
+            return  # missing control file keeps current limits
+        with self.lock:
+            if mtime == self.control_mtime:
+                return
+            self.control_mtime = mtime
+
+        rate, download_rate = self.bucket.rate, self.download_rate
+        try:
+            with open(self.control_file, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    key, _, value = line.partition("=")
+                    key = key.strip()
+                    if key == "rate-limit":
+                        rate = parse_rate(value)
+                    elif key == "download-rate-limit":
+                        download_rate = parse_rate(value)
+                    else:
+                        raise ValueError(f"Unknown key '{key}'")
+        except (OSError, ValueError) as e:
+            self._log(f"Rate limit control file '{self.control_file}' ignored: {e}", LogLevel.ERROR)
+            return
+
+        if (rate, download_rate) != (self.bucket.rate, self.download_rate):
+            self.set_limits(rate, download_rate)
+            self._log(f"Rate limit changed: global {format_rate(rate)}, each download {format_rate(download_rate)}",
+                      LogLevel.WARNING)
+
+    def _log(self, msg: str, level: LogLevel):
+        if self.log_func is not None:
+            self.log_func(msg, level=level)
@@ -1,16 +1,519 @@
-from io import FileIO
+from abc import abstractmethod
+import errno
+import hashlib
+from io import BytesIO, FileIO
+import json
 from math import ceil
-from typing import List
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple
 from . import const
+import mmap
 import os
 from sys import byteorder
+import struct
+import threading
+import time
+import zlib
+
+WRITE_MODE_FILE = "file"
+WRITE_MODE_MMAP = "mmap"
+WRITE_MODE_PWRITE = "pwrite"
+WRITE_MODES = (WRITE_MODE_FILE, WRITE_MODE_MMAP)
+if hasattr(os, 'pwrite'):
+    # positional writes are not available on Windows
+    WRITE_MODES += (WRITE_MODE_PWRITE,)
+
+HASH_MODE_BLOCKS = "blocks"
+HASH_MODE_TREE = "tree"
+HASH_MODES = (HASH_MODE_BLOCKS, HASH_MODE_TREE)
+
+
+# Stat (.udown) file format v2 (all numbers little-endian):
+# - header: [magic][version][flags][slug length][total size][number of segments][slug][CRC32 of the header]
+# - followed by fixed size segment records: [from][to][written][CRC32 of the record]
+#   (new records are appended when some segment is split)
+# Any record could be found and updated in place without reading the others.
+STAT_MAGIC = b"UDWN"
+STAT_VERSION = 2
+_HEADER = struct.Struct("<4sBBHQI")
+_RECORD = struct.Struct("<QQQ")
+_CRC = struct.Struct("<I")
+RECORD_SIZE = _RECORD.size + _CRC.size
+
+# Stat file formats v1 (all numbers have the same byte size - sbs), migrated to v2 on load:
+# - legacy: [sbs][total size][position of segment 0]...[position of segment N-1]
+#   (equal segments of ceil(total size / N) bytes implied)
+# - explicit ranges: [RANGES_MARK][sbs][total size][number of segments]
+#   followed by records [from][to][position] for each segment
+RANGES_MARK = 0  # byte size of legacy stat file is never zero
+
+
+def _to_int(data: bytes) -> int:
+    return int.from_bytes(data, byteorder)
+
+
+def _header_size(slug_len: int) -> int:
+    return _HEADER.size + slug_len + _CRC.size
+
+
+def _pack_header(slug: bytes, size: int, segments: int) -> bytes:
+    header = _HEADER.pack(STAT_MAGIC, STAT_VERSION, 0, len(slug), size, segments) + slug
+    return header + _CRC.pack(zlib.crc32(header))
+
+
+def _unpack_header(data: bytes) -> Optional[Tuple[bytes, int, int]]:
+    """Returns (slug, total size, number of segments) or None when the header is corrupted"""
+    if len(data) < _HEADER.size:
+        return None
+    (magic, version, _, slug_len, size, segments) = _HEADER.unpack_from(data)
+    header_size = _header_size(slug_len)
+    if magic != STAT_MAGIC or len(data) < header_size:
+        return None
+    if version != STAT_VERSION:
+        raise ValueError(f"Unsupported version {version} of the stat file")
+    (crc,) = _CRC.unpack_from(data, header_size - _CRC.size)
+    if crc != zlib.crc32(data[:header_size - _CRC.size]):
+        return None
+    return (data[_HEADER.size:_HEADER.size + slug_len], size, segments)
+
+
+def _pack_record(pfrom: int, pto: int, written: int) -> bytes:
+    record = _RECORD.pack(pfrom, pto, written)
+    return record + _CRC.pack(zlib.crc32(record))
+
+
+def _unpack_record(data: bytes) -> Optional[Tuple[int, int, int]]:
+    """Returns (from, to, written) or None when the record is corrupted"""
+    if len(data) < RECORD_SIZE:
+        return None
+    (crc,) = _CRC.unpack_from(data, _RECORD.size)
+    if crc != zlib.crc32(data[:_RECORD.size]):
+        return None
+    return _RECORD.unpack_from(data)
+
+
+def stat_file_total_size(stat_file: str) -> Optional[int]:
+    """Returns total size of the download recorded in existing stat file (None if unknown)"""
+    if not os.path.isfile(stat_file):
+        return None
+    with open(stat_file, 'rb') as sfp:
+        data = sfp.read(_header_size(0xffff))
+    if data[:len(STAT_MAGIC)] == STAT_MAGIC:
+        header = _unpack_header(data)
+        return header[1] if header is not None else None
+    if not data:
+        return None
+    # v1 formats
+    sbs = data[0]
+    if sbs == RANGES_MARK:
+        return _to_int(data[2:2 + data[1]])
+    return _to_int(data[1:1 + sbs])
+
+
+def missing_space(file: str, size: int) -> int:
+    """Returns number of bytes which are not allocated on the disk yet for the output file of given size"""
+    try:
+        st = os.stat(file)
+    except FileNotFoundError:
+        return size
+    # st_blocks is not available on Windows, but files are not sparse there
+    allocated = st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size
+    return max(0, size - allocated)
+
+
+class CheckpointPolicy:
+    """Policy when the written position of a segment is persisted into the stat file"""
+    max_bytes: int
+    max_interval: float
+
+    def __init__(self, max_bytes: int = const.CHECKPOINT_BYTES, max_interval: int = const.CHECKPOINT_INTERVAL):
+        """
+        Arguments:
+            max_bytes: persist the position at latest after this number of bytes written (0 = after each write)
+            max_interval: persist the position at latest after this number of milliseconds
+        """
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval / 1000
+
+    def is_due(self, pending: int, elapsed: float) -> bool:
+        return pending >= self.max_bytes or elapsed >= self.max_interval
+
+
+class Sink:
+    """Destination of the data of one or more segments"""
+
+    @abstractmethod
+    def write(self, pos: int, data) -> int:
+        """Write data at the given absolute position of the file, returns number of written bytes"""
+        pass
+
+    def flush(self):
+        """Hand all written data to the OS (called before each checkpoint)"""
+        pass
+
+    def sync(self):
+        """Write all data to the disk"""
+        pass
+
+    def interrupt(self, reason: str):
+        """Data of some segment will never come (segment failed or download terminated)"""
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSink(Sink):
+    """Own buffered file handle of one segment, data are written sequentially"""
+    fp: FileIO
+
+    def __init__(self, file: str, pos: int):
+        self.fp = open(file, 'rb+', const.OUTFILE_WRITE_BUF)
+        self.fp.seek(pos, os.SEEK_SET)
+
+    def write(self, pos: int, data) -> int:
+        # file position is kept by the buffered file object itself, no seek needed
+        return self.fp.write(data)
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.close()
+
+
+class MmapSink(Sink):
+    """Whole output file mapped into memory, shared by all segments"""
+    mm: mmap.mmap
+
+    def __init__(self, file: str, size: int):
+        with open(file, 'rb+') as fp:
+            self.mm = mmap.mmap(fp.fileno(), size)
+
+    def write(self, pos: int, data) -> int:
+        # stores into the mapping are in the page cache already, nothing to flush before checkpoint
+        wrt = len(data)
+        self.mm[pos:pos + wrt] = data
+        return wrt
+
+    def sync(self):
+        if not self.mm.closed:
+            self.mm.flush()
+
+    def close(self):
+        if not self.mm.closed:
+            self.mm.flush()
+            self.mm.close()
+
+
+class PwriteSink(Sink):
+    """Single file descriptor shared by all segments, each write goes to its absolute position"""
+    fd: int
+
+    def __init__(self, file: str):
+        self.fd = os.open(file, os.O_RDWR)
+
+    def write(self, pos: int, data) -> int:
+        # unbuffered positional write - no seek, safe from concurrent threads
+        wrt = os.pwrite(self.fd, data, pos)
+        while wrt < len(data):
+            wrt += os.pwrite(self.fd, data[wrt:], pos + wrt)
+        return wrt
+
+    def sync(self):
+        if self.fd >= 0:
+            os.fsync(self.fd)
+
+    def close(self):
+        if self.fd >= 0:
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PipeSink(Sink):
+    """Stream (stdout or a pipe) shared by all segments, data are written strictly in the file order.
+
+    Data ahead of the stream position wait in the reorder buffer. Only data
+    within max_buffer bytes after the stream position are accepted, writers of
+    segments further ahead are blocked (and so their connections) until the
+    stream catches up. Data at the stream position are never blocked, so the
+    earliest segment always proceeds.
+    """
+    out: BinaryIO
+    max_buffer: int
+    pos: int
+    buffered: int
+    pending: Dict[int, bytes]
+    cond: threading.Condition
+    error: Optional[Exception]
+
+    def __init__(self, out: BinaryIO, max_buffer: int = const.STREAM_BUFFER):
+        self.out = out
+        self.max_buffer = max_buffer
+        self.pos = 0
+        self.buffered = 0
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.error = None
+        self._emitting = False
+
+    def write(self, pos: int, data) -> int:
+        wrt = len(data)
+        with self.cond:
+            while self.error is None and pos != self.pos and pos + wrt - self.pos > self.max_buffer:
+                self.cond.wait()
+            if self.error is not None:
+                raise self.error
+            if pos != self.pos or self._emitting:
+                # copy - the chunk could be a reused buffer of the writer
+                self.pending[pos] = bytes(data)
+                self.buffered += wrt
+                return wrt
+            self._emitting = True
+        self._emit(data)
+        return wrt
+
+    def _emit(self, data):
+        """Write data at the stream position and all buffered data following them.
+
+        Only one thread emits at a time, the stream is written outside of the
+        lock, so other writers could fill the buffer meanwhile.
+        """
+        try:
+            while data is not None:
+                self.out.write(data)
+                with self.cond:
+                    self.pos += len(data)
+                    data = self.pending.pop(self.pos, None)
+                    if data is None:
+                        self._emitting = False
+                    else:
+                        self.buffered -= len(data)
+                    self.cond.notify_all()
+        except Exception as e:
+            # e.g. BrokenPipeError - the reader is gone, nobody could write anymore
+            self.interrupt(f"Cannot write into the output stream: {e}")
+            raise
+
+    def interrupt(self, reason: str):
+        with self.cond:
+            if self.error is None:
+                self.error = EOFError(reason)
+            self._emitting = False
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.pending = {}
+            self.buffered = 0
+        if self.error is None:
+            self.out.flush()
+
+
+class StatFile:
+    """Access to the stat (.udown) file through unbuffered file handle"""
+    sfp: FileIO
+    lock: threading.Lock
+
+    def __init__(self, stat_file: str):
+        # stat file must exists - buffering 0 - no need flush()
+        self.sfp = open(stat_file, 'rb+', 0)
+        self.lock = threading.Lock()
+
+    def read(self, pos: int, size: int) -> bytes:
+        with self.lock:
+            self.sfp.seek(pos, os.SEEK_SET)
+            return self.sfp.read(size)
+
+    def write(self, pos: int, data: bytes):
+        with self.lock:
+            self.sfp.seek(pos, os.SEEK_SET)
+            self.sfp.write(data)
+
+    def sync(self):
+        pass
+
+    def close(self):
+        if not self.sfp.closed:
+            self.sfp.close()
+
+
+class MmapStatFile(StatFile):
+    """Stat (.udown) file mapped into memory, a checkpoint is a single store into the mapping"""
+    mm: mmap.mmap
+
+    def __init__(self, stat_file: str):
+        self.sfp = open(stat_file, 'rb+', 0)
+        self.mm = mmap.mmap(self.sfp.fileno(), 0)
+        self.lock = threading.Lock()
+
+    def read(self, pos: int, size: int) -> bytes:
+        with self.lock:
+            return self.mm[pos:pos + size]
+
+    def write(self, pos: int, data: bytes):
+        end = pos + len(data)
+        with self.lock:
+            if end > len(self.mm):
+                # new segment record appended: the file is extended and mapped again
+                # (mmap.resize is not supported on all platforms, e.g. macOS)
+                self.mm.close()
+                self.sfp.truncate(end)
+                self.mm = mmap.mmap(self.sfp.fileno(), 0)
+            self.mm[pos:end] = data
+
+    def sync(self):
+        with self.lock:
+            if not self.mm.closed:
+                self.mm.flush()
+
+    def close(self):
+        with self.lock:
+            if not self.mm.closed:
+                self.mm.flush()
+                self.mm.close()
+        super().close()
+
+
+class PwriteStatFile(StatFile):
+    """Stat (.udown) file accessed by positional reads and writes on a single shared descriptor"""
+    fd: int
+
+    def __init__(self, stat_file: str):
+        self.fd = os.open(stat_file, os.O_RDWR)
+
+    def read(self, pos: int, size: int) -> bytes:
+        return os.pread(self.fd, size, pos)
+
+    def write(self, pos: int, data: bytes):
+        os.pwrite(self.fd, data, pos)
+
+    def sync(self):
+        if self.fd >= 0:
+            os.fsync(self.fd)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class MemoryStatFile(StatFile):
+    """Stat data kept only in memory (nothing is resumed, e.g. when streaming)"""
+    data: bytearray
+
+    def __init__(self, data: bytes):
+        self.data = bytearray(data)
+        self.lock = threading.Lock()
+
+    def read(self, pos: int, size: int) -> bytes:
+        with self.lock:
+            return bytes(self.data[pos:pos + size])
+
+    def write(self, pos: int, data: bytes):
+        with self.lock:
+            end = pos + len(data)
+            if end > len(self.data):
+                self.data.extend(bytes(end - len(self.data)))
+            self.data[pos:end] = data
+
+    def close(self):
+        pass
+
+
+class BlockHashes(StatFile):
+    """SHA-256 digests of fixed size blocks of the output file stored in the .uhash file.
+
+    Blocks are aligned to absolute offsets of the file, so the digests do not
+    depend on the segments layout. Digest of a block not hashed yet is zeros.
+    """
+    size: int
+    blocks: int
+
+    def __init__(self, hash_file: str, size: int, fresh: bool = False):
+        """
+        Arguments:
+            fresh: drop all existing digests (new download)
+        """
+        self.size = size
+        self.blocks = ceil(size / const.HASH_BLOCK_SIZE)
+        length = self.blocks * hashlib.sha256().digest_size
+        if fresh or not os.path.isfile(hash_file) or os.path.getsize(hash_file) != length:
+            with open(hash_file, 'wb') as hfp:
+                hfp.truncate(length)
+        super().__init__(hash_file)
+
+    def store(self, block: int, digest: bytes):
+        self.write(block * len(digest), digest)
+
+    def finalize(self, file: str) -> Tuple[List[bytes], int]:
+        """Returns digests of all blocks and number of blocks which had to be read from the file.
+
+        Blocks not hashed during the download (on boundaries of unaligned
+        segments or downloaded before hashing was enabled) are read and hashed.
+        """
+        digest_size = hashlib.sha256().digest_size
+        data = self.read(0, self.blocks * digest_size)
+        digests = [data[i * digest_size:(i + 1) * digest_size] for i in range(self.blocks)]
+        missing = [i for (i, d) in enumerate(digests) if d == bytes(digest_size)]
+        if missing:
+            with open(file, 'rb') as fp:
+                for i in missing:
+                    fp.seek(i * const.HASH_BLOCK_SIZE, os.SEEK_SET)
+                    digests[i] = hashlib.sha256(fp.read(const.HASH_BLOCK_SIZE)).digest()
+                    self.store(i, digests[i])
+        return (digests, len(missing))
+
+
+class BlockHasher:
+    """Streaming hashing of the blocks written by one segment"""
+    hashes: BlockHashes
+    block_start: int
+    done: List[Tuple[int, bytes]]
+
+    def __init__(self, hashes: BlockHashes, file: str, pfrom: int, pos: int):
+        self.hashes = hashes
+        self.done = []
+        self.block_start = pos - pos % const.HASH_BLOCK_SIZE
+        if self.block_start < pfrom:
+            # block begins in another segment, it is hashed at the end from the file
+            self.hash = None
+        else:
+            self.hash = hashlib.sha256()
+            if pos > self.block_start:
+                # resumed in the middle of the block, restore the state from already written data
+                with open(file, 'rb') as fp:
+                    fp.seek(self.block_start, os.SEEK_SET)
+                    self.hash.update(fp.read(pos - self.block_start))
+
+    def update(self, pos: int, data):
+        """Feed data written at given position (continuing after previous data)"""
+        view = memoryview(data)
+        off = 0
+        while off < len(view):
+            block_end = min(self.block_start + const.HASH_BLOCK_SIZE, self.hashes.size)
+            n = min(len(view) - off, block_end - (pos + off))
+            if self.hash is not None:
+                self.hash.update(view[off:off + n])
+            off += n
+            if pos + off == block_end:
+                if self.hash is not None:
+                    self.done.append((self.block_start // const.HASH_BLOCK_SIZE, self.hash.digest()))
+                self.block_start = block_end
+                self.hash = hashlib.sha256()
+
+    def persist(self):
+        """Store digests of completed blocks (called on checkpoint before the position is stored)"""
+        for (block, digest) in self.done:
+            self.hashes.store(block, digest)
+        self.done = []
 
 
 class SegFile:
     """Implementation segment file"""
     file: str
     stat_file: str
-    parts: int
     id: int
 
     size: int
@@ -18,128 +521,470 @@ class SegFile:
     pfrom: int
     pto: int
 
-    sfp: FileIO
-    sbs: int
+    sink: Optional[Sink]
+    stat: StatFile
+    stat_pos: int
+    closed: bool
 
-    def __init__(self, file: str, stat_file: str, parts: int, seg_idx: int):
+    def __init__(self, file: str, stat_file: str, seg_idx: int, sink: Sink = None, stat: StatFile = None):
+        """
+        Arguments:
+            sink, stat: shared sink and stat file (owned by the caller), own ones are opened when not given
+                        (own sink with the first write, so only running segments hold a file handle)
+        """
         self.file = file
         self.stat_file = stat_file
-        self.parts = parts
         self.id = seg_idx
+        self.sink = sink
+        self.stat = stat
+        self._own_sink = sink is None
+        self._own_stat = stat is None
         self.open()
 
     def open(self):
-        self.fp = open(self.file, 'rb+', const.OUTFILE_WRITE_BUF)
+        if self._own_stat:
+            self.stat = StatFile(self.stat_file)
         self._load_stat()
+        self.closed = False
 
     def _load_stat(self):
-        # open stat file - must exists - buffering 0 - no need flush()
-        self.sfp = open(self.stat_file, 'rb+', 0)
-        # byte size of stat segment
-        self.sbs = int.from_bytes(self.sfp.read(1), byteorder)
-        # total_size
-        total_size = int.from_bytes(self.sfp.read(self.sbs), byteorder)
-
-        # size, from, to
-        self.size = ceil(total_size / self.parts)
-        self.pfrom = self.size * self.id
-        self.pto = min(((self.size * (self.id + 1)) - 1), total_size)
-
-        # fix last part have different size
-        if self.id == (self.parts - 1):
-            self.size = total_size - self.pfrom
-
-        # get written
-        self._read_stat()
-
-        # seek file position
-        self.fp.seek(self.cur_pos, os.SEEK_SET)
-
-    def _read_stat(self):
-        self.stat_pos = 1 + self.sbs + (self.id * self.sbs)
-        self.sfp.seek(self.stat_pos, os.SEEK_SET)
-        self.cur_pos = int.from_bytes(self.sfp.read(self.sbs), byteorder)
-        self.written = self.cur_pos - self.pfrom
+        # header is validated by the loader already, only the slug length is needed to locate the record
+        (_, _, _, slug_len, _, _) = _HEADER.unpack(self.stat.read(0, _HEADER.size))
+        self.stat_pos = _header_size(slug_len) + self.id * RECORD_SIZE
+        record = _unpack_record(self.stat.read(self.stat_pos, RECORD_SIZE))
+        if record is None:
+            raise ValueError(f"Corrupted record of segment {self.id} in the stat file")
+
+        # from, to, size, written
+        (self.pfrom, self.pto, self.written) = record
+        self.size = self.pto - self.pfrom + 1
+        self.cur_pos = self.pfrom + self.written
+
+    def remaining(self) -> int:
+        return self.pto + 1 - self.cur_pos
 
     def close(self):
-        if not self.sfp.closed:
-            self.sfp.close()
-        if not self.fp.closed:
-            self.fp.close()
+        self.closed = True
+        if self._own_stat:
+            self.stat.close()
+        if self._own_sink and self.sink is not None:
+            self.sink.close()
+            self.sink = None
 
 
 class SegFileWriter(SegFile):
     """Implementation segment write file"""
+    policy: CheckpointPolicy
+    checkpoint_pos: int
+    checkpoint_time: float
+    lock: threading.Lock
 
-    def _write_stat(self, newpos):
-        self.sfp.seek(self.stat_pos, os.SEEK_SET)
-        self.sfp.write(newpos.to_bytes(self.sbs, byteorder))
+    def __init__(self, file: str, stat_file: str, seg_idx: int, policy: CheckpointPolicy = None,
+                 sink: Sink = None, stat: StatFile = None, hashes: BlockHashes = None):
+        """
+        Arguments:
+            hashes: when given, blocks are hashed while written
+        """
+        self.policy = policy if policy is not None else CheckpointPolicy()
+        self.lock = threading.Lock()
+        super().__init__(file, stat_file, seg_idx, sink, stat)
+        self.checkpoint_pos = self.cur_pos
+        self.checkpoint_time = time.monotonic()
+        self.hasher = BlockHasher(hashes, file, self.pfrom, self.cur_pos) if hashes is not None else None
 
-    def write(self, chunk):
-        self.fp.seek(self.cur_pos, os.SEEK_SET)
-        wrt = self.fp.write(chunk)
-        self.fp.flush()
-        self.written += wrt
-        self.cur_pos += wrt
-        self._write_stat(self.cur_pos)
+    def _write_stat(self):
+        # whole record is rewritten in place (including its CRC)
+        self.stat.write(self.stat_pos, _pack_record(self.pfrom, self.pto, self.checkpoint_pos - self.pfrom))
+
+    def _set_pto(self, pto):
+        """Shorten the segment (rest is downloaded as another segment), must be called with lock held"""
+        self.pto = pto
+        self.size = self.pto - self.pfrom + 1
+        self._write_stat()
+
+    def write(self, chunk) -> int:
+        """Write chunk at the current position, returns number of written bytes.
+
+        Data behind the end of the segment (which could be shortened by split)
+        are thrown away.
+        """
+        with self.lock:
+            if self.closed:
+                raise ValueError(f"Segment {self.id} is closed")
+            if len(chunk) > self.remaining():
+                chunk = chunk[:self.remaining()]
+            if self.sink is None:
+                self.sink = FileSink(self.file, self.cur_pos)
+            wrt = self.sink.write(self.cur_pos, chunk)
+            if self.hasher is not None:
+                self.hasher.update(self.cur_pos, chunk)
+            self.written += wrt
+            self.cur_pos += wrt
+            if self.policy.is_due(self.cur_pos - self.checkpoint_pos, time.monotonic() - self.checkpoint_time):
+                self.checkpoint()
+        return wrt
+
+    def checkpoint(self):
+        """Persist the current position into the stat file.
+
+        Buffered data are flushed first, so the recorded position never runs
+        ahead of the data really written into the file.
+        """
+        if self.closed:
+            return
+        if self.sink is not None:
+            self.sink.flush()
+        if self.hasher is not None:
+            self.hasher.persist()
+        if self.cur_pos != self.checkpoint_pos:
+            self.checkpoint_pos = self.cur_pos
+            self._write_stat()
+        self.checkpoint_time = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.checkpoint()
+            if self.remaining() > 0 and self.sink is not None:
+                self.sink.interrupt(f"Data of segment {self.id} from position {self.cur_pos} were not downloaded")
+            if not self._own_sink:
+                # part completed - occasional sync of the shared sink and stat file (data first)
+                self.sink.sync()
+                self.stat.sync()
+            super().close()
 
 
 class SegFileLoader:
-    def __init__(self, file: str, stat_file: str, size: int, parts: int):
+    """Creates (or loads existing) output and stat file and makes writers for all segments"""
+    segments: int
+    part_size: int
+    lock: threading.Lock
+
+    def __init__(self, file: str, stat_file: str, size: int, parts: int, policy: CheckpointPolicy = None,
+                 mode: str = WRITE_MODE_FILE, preallocate: bool = False, slug: str = "", log_func: Callable = None,
+                 hash_file: str = None, segment_size: int = 0):
+        """
+        Arguments:
+            segment_size: slice new download into segments of at most this size (but at least into `parts`
+                          segments), 0 = `parts` equal segments; layout of resumed download is kept
+            slug: identification of the downloaded file, stat file of another file is not resumed
+            log_func: function for logging of stat file migrations and recoveries
+            hash_file: file for digests of blocks when data should be hashed while written
+        """
         self.file = file
         self.stat_file = stat_file
         self.size = size
         self.parts = parts
+        self.policy = policy
+        self.mode = mode
+        self.preallocate = preallocate
+        self.segment_size = segment_size
+        self.slug = slug.encode("utf-8")
+        self.header_size = _header_size(len(self.slug))
+        self.log_func = log_func
+        self.hash_file = hash_file
+        # segments are made of whole hash blocks, so they could be hashed while written
+        self.align = const.HASH_BLOCK_SIZE if hash_file else 1
+        self.sink = None
+        self.stat = None
+        self.hashes = None
+        self.lock = threading.Lock()
         self._first_created = False
         # create stat file if not exists
         self._create_files_if_not_ex()
 
+    def _log(self, msg: str):
+        if self.log_func is not None:
+            self.log_func(msg)
+
     def make_writers(self) -> List[SegFileWriter]:
         if self._first_created:
             self.fp.close()
             self.sfp.close()
-            parts = self.parts
         else:
-            parts = self._get_parts_from_existing()
-            self.parts = parts
+            self._load_existing()
 
-        return [SegFileWriter(self.file, self.stat_file, parts, i) for i in range(parts)]
+        shared = True
+        # an empty file (and the stat file without segments) cannot be mapped
+        mode = WRITE_MODE_FILE if self.mode == WRITE_MODE_MMAP and not self.size else self.mode
+        if mode == WRITE_MODE_MMAP:
+            self.sink = MmapSink(self.file, self.size)
+            self.stat = MmapStatFile(self.stat_file)
+        elif mode == WRITE_MODE_PWRITE:
+            self.sink = PwriteSink(self.file)
+            self.stat = PwriteStatFile(self.stat_file)
+        else:
+            # writers open own data handles when started, the stat file is shared (records are written
+            # at their offsets), so the number of open files does not grow with the number of segments
+            self.stat = PwriteStatFile(self.stat_file) if hasattr(os, "pwrite") else StatFile(self.stat_file)
+            shared = False
 
-    def _get_parts_from_existing(self):
-        self.sfp = open(self.stat_file, 'rb')
-        sbs = int.from_bytes(self.sfp.read(1), byteorder)
-        size = int.from_bytes(self.sfp.read(sbs), byteorder)
+        if self.hash_file:
+            self.hashes = BlockHashes(self.hash_file, self.size, fresh=self._first_created)
+
+        self._shared = shared
+        return [self._make_writer(i) for i in range(self.segments)]
+
+    def _make_writer(self, seg_idx: int) -> SegFileWriter:
+        if self._shared:
+            return SegFileWriter(self.file, self.stat_file, seg_idx, self.policy, self.sink, self.stat, self.hashes)
+        return SegFileWriter(self.file, self.stat_file, seg_idx, self.policy, stat=self.stat, hashes=self.hashes)
+
+    def split(self, writer: SegFileWriter, min_size: int, keep: float = 0.5) -> Optional[SegFileWriter]:
+        """Split the rest of given writer's segment (in halves by default).
 
-        parts_bytes_remain = self.sfp.read()  # read bytes remain
-        parts = int(len(parts_bytes_remain) / sbs)
-        self.part_size = ceil(size / parts)
+        The writer is shortened to the `keep` share of its rest, the other part
+        becomes a new segment, its writer is returned. Both parts have at least
+        min_size bytes. Returns None when the rest is too small (less than
+        2 * min_size) or the writer is closed already.
+        """
+        with self.lock:
+            with writer.lock:
+                remaining = writer.remaining()
+                if writer.closed or remaining < 2 * min_size:
+                    return None
+                keep_size = min(max(int(remaining * keep), min_size), remaining - min_size)
+                mid = (writer.cur_pos + keep_size) // self.align * self.align
+                if mid <= writer.cur_pos:
+                    return None
+                # the new segment is persisted before the old one is shortened, so the
+                # range is always covered by some segment (at worst by both of them)
+                seg_idx = self._add_segment(mid, writer.pto)
+                writer._set_pto(mid - 1)
+            return self._make_writer(seg_idx)
+
+    def _add_segment(self, pfrom: int, pto: int) -> int:
+        seg_idx = self.segments
+        self.stat.write(self.header_size + seg_idx * RECORD_SIZE, _pack_record(pfrom, pto, 0))
+        # record is complete, now count it (record behind the count is ignored on load)
+        self.segments += 1
+        self.stat.write(0, _pack_header(self.slug, self.size, self.segments))
+        return seg_idx
+
+    def interrupt(self, reason: str):
+        """Wake up writers blocked by the shared sink, their writes fail (download terminated)"""
+        if self.sink is not None:
+            self.sink.interrupt(reason)
+
+    def close(self):
+        """Close sink and stat file shared by writers (call after all writers are closed)"""
+        if self.sink is not None:
+            self.sink.close()
+        if self.stat is not None:
+            self.stat.close()
+        if self.hashes is not None:
+            self.hashes.close()
+
+    def write_manifest(self, manifest_file: str, tree: bool = False) -> Optional[str]:
+        """Write manifest with digests of all blocks of the completed download.
+
+        Arguments:
+            tree: add also whole file digest (SHA-256 of concatenated block digests)
+        Returns:
+            str: hex whole file digest in the tree mode
+        """
+        hashes = BlockHashes(self.hash_file, self.size)
+        try:
+            (digests, reread) = hashes.finalize(self.file)
+        finally:
+            hashes.close()
+        if reread:
+            self._log(f"{reread} of {len(digests)} blocks were not hashed while downloading and were read from the disk")
+
+        manifest = {
+            "file": os.path.basename(self.file),
+            "size": self.size,
+            "algorithm": "sha256",
+            "block_size": const.HASH_BLOCK_SIZE,
+            "blocks": [d.hex() for d in digests],
+        }
+        if tree:
+            manifest["tree"] = hashlib.sha256(b"".join(digests)).hexdigest()
+        with open(manifest_file, 'w') as mfp:
+            json.dump(manifest, mfp, indent=1)
+        return manifest.get("tree")
+
+    def _load_existing(self):
+        self.sfp = open(self.stat_file, 'rb')
+        data = self.sfp.read()
         self.sfp.close()
 
-        # if file size not match is not same file - truncate to fresh new
-        if self.size != size:
+        slug = None
+        rewrite = True
+        if data[:len(STAT_MAGIC)] == STAT_MAGIC:
+            (slug, size, ranges, rewrite) = self._parse_stat_data(data)
+        elif len(data) > 2 and data[0] == RANGES_MARK:
+            self._log("Migrating .udown file to the format v2")
+            (size, ranges) = self._parse_v1_ranges_data(data)
+        elif len(data) > 1:
+            self._log("Migrating .udown file to the format v2")
+            (size, ranges) = self._parse_v1_legacy_data(data)
+        else:
+            self._log("WARNING: Empty .udown file, downloaded data cannot be resumed")
+            (size, ranges) = (self.size, [])
+
+        # if it is not the same file (or the output file is missing) - truncate to fresh new
+        same_file = size == self.size and (slug is None or slug == self.slug)
+        if not same_file or not os.path.isfile(self.file) or os.path.getsize(self.file) != self.size:
+            os.remove(self.stat_file)
             self._create_files_if_not_ex()
-            return self.parts
+            self.fp.close()
+            self.sfp.close()
+            return
+
+        # ranges lost by corruption are downloaded again
+        ranges += [(pfrom, pto, 0) for (pfrom, pto) in self._uncovered_ranges(ranges)]
+        self.segments = len(ranges)
+        self.part_size = ceil(size / max(self.segments, 1))
+
+        if rewrite:
+            tmp_file = self.stat_file + ".tmp"
+            with open(tmp_file, 'wb') as sfp:
+                self._write_stat_data(sfp, ranges)
+            os.replace(tmp_file, self.stat_file)
+
+    def _parse_stat_data(self, data: bytes) -> Tuple[bytes, int, List[Tuple[int, int, int]], bool]:
+        """Parse stat file in format v2.
+
+        Returns (slug, total size, ranges, rewrite), corrupted parts are thrown
+        away and rewrite is set in such case.
+        """
+        rewrite = False
+        header = _unpack_header(data)
+        if header is not None:
+            (slug, size, segments) = header
+            header_size = _header_size(len(slug))
         else:
-            return parts
+            # try to recover records of current file (which has the same header size)
+            self._log("WARNING: Corrupted header of .udown file, trying to recover segments")
+            rewrite = True
+            (slug, size) = (self.slug, self.size)
+            header_size = self.header_size
+            segments = (len(data) - header_size) // RECORD_SIZE
+
+        ranges = []
+        corrupted = 0
+        for i in range(segments):
+            pos = header_size + i * RECORD_SIZE
+            record = _unpack_record(data[pos:pos + RECORD_SIZE])
+            if record is None or not (record[0] <= record[1] < size and record[2] <= record[1] - record[0] + 1):
+                corrupted += 1
+                continue
+            ranges.append(record)
+        if corrupted:
+            self._log(f"WARNING: {corrupted} corrupted segment(s) in .udown file, they will be downloaded again")
+            rewrite = True
+        return (slug, size, ranges, rewrite)
+
+    @staticmethod
+    def _parse_v1_ranges_data(data: bytes) -> Tuple[int, List[Tuple[int, int, int]]]:
+        sbs = data[1]
+        size = _to_int(data[2:2 + sbs])
+        segments = _to_int(data[2 + sbs:2 + 2 * sbs])
+        values = [_to_int(data[2 + (2 + i) * sbs:2 + (3 + i) * sbs]) for i in range(3 * segments)]
+        ranges = [(values[i], values[i + 1], values[i + 2] - values[i]) for i in range(0, 3 * segments, 3)]
+        return (size, ranges)
+
+    @staticmethod
+    def _parse_v1_legacy_data(data: bytes) -> Tuple[int, List[Tuple[int, int, int]]]:
+        # implied equal segments
+        sbs = data[0]
+        size = _to_int(data[1:1 + sbs])
+        parts = (len(data) - 1 - sbs) // sbs
+        positions = [_to_int(data[1 + sbs + i * sbs:1 + sbs + (i + 1) * sbs]) for i in range(parts)]
+        ranges = [(pfrom, pto, min(pos, pto + 1) - pfrom)
+                  for ((pfrom, pto), pos) in zip(SegFileLoader._equal_ranges(size, parts), positions)]
+        return (size, ranges)
+
+    def _uncovered_ranges(self, ranges: List[Tuple[int, int, int]]) -> List[Tuple[int, int]]:
+        uncovered = []
+        pos = 0
+        for (pfrom, pto, _) in sorted(ranges):
+            if pfrom > pos:
+                uncovered.append((pos, pfrom - 1))
+            pos = max(pos, pto + 1)
+        if pos < self.size:
+            uncovered.append((pos, self.size - 1))
+        return uncovered
 
     def _create_files_if_not_ex(self):
         if not os.path.isfile(self.stat_file):
             self.fp = open(self.file, 'wb+')
-            self.fp.truncate(self.size)
+            try:
+                self._allocate()
+            except OSError:
+                # e.g. ENOSPC - do not leave half allocated file behind
+                self.fp.close()
+                os.remove(self.file)
+                raise
             self.sfp = open(self.stat_file, 'wb+')
 
             self._make_stat_file_data(self.size, self.parts)
             self._first_created = True
 
+    def _allocate(self):
+        if self.preallocate and self.size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                # real allocation of all blocks - less fragmentation and ENOSPC right now instead of later
+                os.posix_fallocate(self.fp.fileno(), 0, self.size)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                    raise
+                # filesystem does not support fallocate, fallback to sparse file
+        self.fp.truncate(self.size)
+
+    @staticmethod
+    def _equal_ranges(size: int, parts: int, align: int = 1) -> List[Tuple[int, int]]:
+        part_size = ceil(ceil(size / parts) / align) * align
+        return [(i * part_size, min((i + 1) * part_size, size) - 1) for i in range(parts) if i * part_size < size]
+
     def _make_stat_file_data(self, size, parts):
-        self.part_size = ceil(size / parts)
-        sb_size = ceil(size.bit_length() / 8) + 1
+        if self.segment_size > 0:
+            parts = max(parts, ceil(size / self.segment_size))
+        ranges = [(pfrom, pto, 0) for (pfrom, pto) in self._equal_ranges(size, parts, self.align)]
+        self.segments = len(ranges)
+        self.part_size = ranges[0][1] - ranges[0][0] + 1 if ranges else 0
+        self._write_stat_data(self.sfp, ranges)
+
+    def _write_stat_data(self, sfp: FileIO, ranges: List[Tuple[int, int, int]]):
+        sfp.write(_pack_header(self.slug, self.size, len(ranges)))
+        for (pfrom, pto, written) in ranges:
+            sfp.write(_pack_record(pfrom, pto, written))
+
+
+class StreamLoader(SegFileLoader):
+    """Makes writers of segments for downloading into a stream (stdout or a pipe) in the file order.
 
-        self.sfp.write(sb_size.to_bytes(1, byteorder))
-        self.sfp.write(size.to_bytes(sb_size, byteorder))
+    Nothing is stored on the disk, so the download cannot be resumed. Segments
+    are small enough for all parallel parts to fit into the reorder buffer of
+    PipeSink together, parts should be started in the order of segments.
+    """
+    out: BinaryIO
+    max_buffer: int
+
+    def __init__(self, out: BinaryIO, size: int, parts: int, max_buffer: int = const.STREAM_BUFFER,
+                 policy: CheckpointPolicy = None, slug: str = "", segment_size: int = 0):
+        super().__init__(None, None, size, parts, policy, slug=slug, segment_size=segment_size)
+        self.out = out
+        self.max_buffer = max_buffer
+        self._first_created = True
+        self._shared = True
+
+    def _create_files_if_not_ex(self):
+        pass  # nothing is stored on the disk
+
+    def make_writers(self) -> List[SegFileWriter]:
+        seg_size = min(ceil(self.size / self.parts), max(self.max_buffer // self.parts, const.MIN_SPLIT_SIZE))
+        if self.segment_size > 0:
+            seg_size = min(seg_size, self.segment_size)
+        ranges = [(pfrom, pto, 0) for (pfrom, pto) in self._equal_ranges(self.size, max(1, ceil(self.size / max(1, seg_size))))]
+        self.segments = len(ranges)
+        self.part_size = ranges[0][1] - ranges[0][0] + 1 if ranges else 0
 
-        for i in range(parts):
-            stat_pos = 1 + sb_size + (i * sb_size)
-            self.sfp.seek(stat_pos, os.SEEK_SET)
-            seg = (i * self.part_size).to_bytes(sb_size, byteorder)
-            self.sfp.write(seg)
+        data = BytesIO()
+        self._write_stat_data(data, ranges)
+        self.stat = MemoryStatFile(data.getvalue())
+        self.sink = PipeSink(self.out, self.max_buffer)
+        return [self._make_writer(i) for i in range(self.segments)]
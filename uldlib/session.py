@@ -0,0 +1,71 @@
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .const import POOL_HOSTS
+
+
+class SessionPool:
+    """HTTP session shared by the downloader (HEAD, parts) and CAPTCHA solvers with keep-alive connections.
+
+    Connections are pooled per host, the pool of each host holds up to pool_size
+    idle connections (one for each part), so a retry or a part taking over the
+    download link of a completed part does not pay a new TCP and TLS handshake.
+    """
+    session: requests.Session
+    pool_size: int
+
+    def __init__(self, pool_size: int = 10):
+        self.session = requests.Session()
+        self.pool_size = 0
+        self.resize(pool_size)
+
+    def resize(self, pool_size: int):
+        """Set number of kept connections per host (existing connections are dropped when changed)"""
+        if pool_size == self.pool_size:
+            return
+        self.pool_size = pool_size
+        old_adapters = {self.session.get_adapter("http://"), self.session.get_adapter("https://")}
+        adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        for old_adapter in old_adapters:
+            old_adapter.close()
+
+    def stats(self) -> Dict[str, int]:
+        """Returns number of opened connections and sent requests of all pools"""
+        stats = {"connections": 0, "requests": 0}
+        for adapter in set(self.session.adapters.values()):
+            managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+            for manager in managers:
+                for key in manager.pools.keys():
+                    try:
+                        pool = manager.pools[key]
+                    except KeyError:
+                        continue  # removed meanwhile
+                    stats["connections"] += pool.num_connections
+                    stats["requests"] += pool.num_requests
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
+def release(r: requests.Response):
+    """Return connection of the response into the pool when its body was read completely, close it otherwise"""
+    fp = getattr(r.raw, '_fp', None)
+    if fp is not None and fp.isclosed():
+        r.raw.release_conn()
+    else:
+        # unread data would be received by the next request on this connection
+        r.close()
+
+
+def content_range_size(content_range: str) -> Optional[int]:
+    """Returns the complete length from Content-Range header value (e.g. 'bytes 0-99/1234'), None when unknown"""
+    (unit, _, rest) = content_range.strip().partition(' ')
+    (_, _, size) = rest.partition('/')
+    if unit != 'bytes' or not size.isdigit():
+        return None
+    return int(size)
@@ -1,15 +1,21 @@
-from typing import Callable
+import itertools
+import os
+import shutil
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from os import path
+from typing import Callable, Dict, Iterator, List, Optional, Set, TextIO, Tuple
+from urllib.parse import urlparse
 
 import stem.process
 import stem.control
-from uldlib.utils import get_available_port
-
-sockPort = get_available_port(9050)
-controlPort = get_available_port(9051, skip=[sockPort])
+from uldlib.const import EXIT_REPUTATION_FILE, TOR_CONSENSUS_MAX_AGE, TOR_DATA_DIR_PREFIX, TOR_DATA_DIRS_MAX, TOR_STOP_TIMEOUT
+from uldlib.exits import ExitReputation
+from uldlib.utils import LogLevel, get_available_port, try_lock_file
 
 TOR_CONFIG = {
-    'SocksPort': f"{sockPort}",
-    "ControlPort": f"{controlPort}",
     'SocksListenAddress': '127.0.0.1',
     'SocksPolicy': 'accept 127.0.0.1',
     'CookieAuthentication': '1',
@@ -19,11 +25,48 @@ TOR_CONFIG = {
     ],
 }
 
+_ports_lock = threading.Lock()
+_used_ports: Set[int] = set()
+# SOCKS usernames of isolated circuits
+_isolation_ids = itertools.count()
+
+
+def _allocate_ports() -> Tuple[int, int]:
+    """Returns free SOCKS and control ports not used by other Tor instances of this process"""
+    with _ports_lock:
+        sock_port = get_available_port(9050, skip=list(_used_ports))
+        control_port = get_available_port(9051, skip=list(_used_ports) + [sock_port])
+        _used_ports.update((sock_port, control_port))
+        return sock_port, control_port
+
+
+def _release_ports(*ports: Optional[int]) -> None:
+    """Ports of a stopped Tor instance can be allocated again"""
+    with _ports_lock:
+        _used_ports.difference_update(ports)
+
 
 class TorRunner:
     """
     A class that manages running and stopping a Tor process.
+
+    Tor keeps its data (consensus, descriptors, guards) in a data directory under temp_dir
+    reused by next runs, so it bootstraps from its cache instead of downloading the directory
+    data again. Each directory is locked by the instance using it, concurrent instances use
+    the next free one (tor_data_dir_0, tor_data_dir_1, …).
     """
+    data_dir: Optional[str] = None
+    data_dir_lock: Optional[TextIO] = None
+    # ports are allocated when Tor is started
+    sock_port: Optional[int] = None
+    control_port: Optional[int] = None
+    # data directory of another instance with directory data copied before a cold bootstrap
+    seed_dir: Optional[str] = None
+    # persistent connection to the control port, opened when first needed
+    controller: Optional[stem.control.Controller] = None
+    # exits limited or blocked recently are excluded (ExcludeExitNodes)
+    reputation: Optional[ExitReputation] = None
+    excluded: Tuple[str, ...] = ()
 
     def __init__(self, temp_dir: str, log_func: Callable) -> None:
         """
@@ -34,11 +77,29 @@ class TorRunner:
             log_func (Callable): a function that will be called to log messages.
         """
         self.tor_process = None
+        self.lock = threading.Lock()
+        self.controller_lock = threading.Lock()
+        self.bootstrap_thread = None
+        self.stopped = False
         self.log_func = log_func
         self.temp_dir = temp_dir
-        self.proxies = {
-            'http': f'socks5://127.0.0.1:{TOR_CONFIG.get("SocksPort")}',
-            'https': f'socks5://127.0.0.1:{TOR_CONFIG.get("SocksPort")}'
+
+    @property
+    def proxies(self) -> Dict[str, str]:
+        return {
+            'http': f'socks5://127.0.0.1:{self.sock_port}',
+            'https': f'socks5://127.0.0.1:{self.sock_port}'
+        }
+
+    def isolated_proxies(self) -> Dict[str, str]:
+        """
+        Proxies with unique SOCKS credentials, Tor uses a circuit of their own for them (IsolateSOCKSAuth),
+        so concurrent sessions get independent circuits (and exit IPs) without NEWNYM.
+        """
+        auth = f'uldlib{os.getpid()}:{next(_isolation_ids)}'
+        return {
+            'http': f'socks5://{auth}@127.0.0.1:{self.sock_port}',
+            'https': f'socks5://{auth}@127.0.0.1:{self.sock_port}'
         }
 
     def start(self) -> None:
@@ -46,32 +107,266 @@ class TorRunner:
         Starts the Tor process with the given configuration.
         """
         try:
-            self.tor_process = stem.process.launch_tor_with_config(config=TOR_CONFIG)
-            self.log_func("TOR started")
+            if self.data_dir is None:
+                self.data_dir = self._acquire_data_dir()
+            if self.sock_port is None:
+                (self.sock_port, self.control_port) = _allocate_ports()
+            if not self._has_fresh_consensus():
+                self._seed()
+            warm = self._has_fresh_consensus()
+            started = time.time()
+            try:
+                self.tor_process = self._launch_tor()
+            except Exception as e:
+                if not os.path.isdir(self.data_dir) or not os.listdir(self.data_dir):
+                    raise  # nothing from previous runs (e.g. tor is not installed)
+                # stale or damaged state of a previous run, start from scratch
+                self.log_func(f"TOR failed to start with data directory '{self.data_dir}' ({e}), cleaning it",
+                              level=LogLevel.WARNING)
+                shutil.rmtree(self.data_dir, ignore_errors=True)
+                (warm, started) = (False, time.time())
+                self.tor_process = self._launch_tor()
+            self.log_func("TOR started in {:.1f} s ({} bootstrap)".format(
+                time.time() - started, "warm, cached directory data" if warm else "cold"))
         except Exception as e:
             self.log_func(f"Unable to start TOR: {e}")
             raise
 
+    def _launch_tor(self) -> subprocess.Popen:
+        config = dict(TOR_CONFIG, SocksPort=f"{self.sock_port} IsolateSOCKSAuth", ControlPort=str(self.control_port),
+                      DataDirectory=os.path.abspath(self.data_dir))
+        # Tor exits by itself when this process dies (e.g. killed during the bootstrap)
+        return stem.process.launch_tor_with_config(config=config, take_ownership=True)
+
+    def _acquire_data_dir(self) -> str:
+        """Returns the first data directory not locked by another instance (and locks it)"""
+        for i in range(TOR_DATA_DIRS_MAX):
+            data_dir = path.join(self.temp_dir, f"{TOR_DATA_DIR_PREFIX}{i}")
+            # the lock file is next to the directory, Tor could remove the content of the directory
+            lock = open(data_dir + ".lock", "a")
+            if try_lock_file(lock):
+                self.data_dir_lock = lock
+                return data_dir
+            lock.close()
+        raise RuntimeError(f"All {TOR_DATA_DIRS_MAX} TOR data directories in '{self.temp_dir}' are used by other instances")
+
+    def _has_fresh_consensus(self, data_dir: str = None) -> bool:
+        """Whether the data directory holds directory data recent enough for a warm bootstrap"""
+        for name in ("cached-microdesc-consensus", "cached-consensus"):
+            try:
+                if time.time() - os.stat(path.join(data_dir or self.data_dir, name)).st_mtime < TOR_CONSENSUS_MAX_AGE:
+                    return True
+            except OSError:
+                pass
+        return False
+
+    def _seed(self):
+        """Copy cached directory data (consensus, certificates, descriptors) of the seed instance"""
+        if self.seed_dir is None or not self._has_fresh_consensus(self.seed_dir):
+            return
+        try:
+            os.makedirs(self.data_dir, mode=0o700, exist_ok=True)
+            for name in os.listdir(self.seed_dir):
+                if name.startswith("cached-"):
+                    shutil.copy2(path.join(self.seed_dir, name), path.join(self.data_dir, name))
+        except OSError as e:
+            self.log_func(f"Cannot copy TOR directory data from '{self.seed_dir}': {e}", level=LogLevel.WARNING)
+
     def launch(self) -> None:
         """
-        Launches the Tor process if it has not been started.
+        Launches the Tor process if it has not been started (waits for the bootstrap started by launch_background).
+        """
+        thread = self.bootstrap_thread
+        if thread is not None:
+            thread.join()
+        with self.lock:
+            if not self.tor_process:
+                self.start()
+
+    def launch_background(self) -> None:
+        """
+        Starts the Tor process in a background thread, so that it bootstraps while other work is done.
+        Failure is only logged, launch() tries to start Tor again when it is needed.
+        """
+        if self.tor_process or self.bootstrap_thread is not None:
+            return
+        self.bootstrap_thread = threading.Thread(target=self._bootstrap, daemon=True)
+        self.bootstrap_thread.start()
+
+    def _bootstrap(self) -> None:
+        try:
+            with self.lock:
+                if not self.tor_process and not self.stopped:
+                    self.start()
+        except Exception:
+            pass  # logged by start()
+        if self.stopped:
+            # stopped during the bootstrap
+            self.stop()
+
+    def get_controller(self) -> stem.control.Controller:
+        """
+        Returns the persistent authenticated connection to the control port of the launched Tor
+        (e.g. for diagnostics of circuits), it is opened again when closed.
+        """
+        with self.controller_lock:
+            if self.controller is None or not self.controller.is_alive():
+                controller = stem.control.Controller.from_port(port=self.control_port)
+                controller.authenticate()
+                self.controller = controller
+            return self.controller
+
+    def exit_fingerprint(self, proxies: Dict[str, str]) -> Optional[str]:
+        """
+        Returns fingerprint of the exit relay of the circuit isolated for given proxies (see isolated_proxies).
+        """
+        proxy = urlparse(proxies['https'])
+        for circuit in self.get_controller().get_circuits():
+            if (circuit.socks_username, circuit.socks_password) == (proxy.username, proxy.password) and circuit.path:
+                return circuit.path[-1][0]
+        return None
+
+    def record_exit(self, proxies: Dict[str, str], result: str) -> None:
+        """
+        Records the result of an attempt over the isolated circuit of given proxies into the exit reputation.
+        """
+        if self.reputation is None:
+            return
+        try:
+            fingerprint = self.exit_fingerprint(proxies)
+        except Exception as e:
+            self.log_func(f"Cannot get exit relay of the TOR circuit: {e}", level=LogLevel.WARNING)
+            return
+        if fingerprint is not None:
+            self.reputation.record(fingerprint, result)
+
+    def exclude_bad_exits(self) -> None:
+        """
+        Excludes exits with bad reputation from new circuits (when they changed since the last call).
         """
-        if not self.tor_process:
-            self.start()
+        if self.reputation is None:
+            return
+        bad = tuple(self.reputation.bad_exits())
+        if bad == self.excluded:
+            return
+        try:
+            self.get_controller().set_conf("ExcludeExitNodes", ",".join(bad) if bad else None)
+        except Exception as e:
+            self.log_func(f"Cannot exclude TOR exit relays: {e}", level=LogLevel.WARNING)
+            return
+        self.excluded = bad
+        self.log_func(f"Excluded {len(bad)} TOR exit relays limited or blocked recently")
 
-    @staticmethod
-    def reload() -> None:
+    def reload(self) -> None:
         """
-        Reloads the Tor process with a new circuit.
+        Switches all new connections to new circuits (NEWNYM, rate-limited by Tor).
         """
-        CONTROL_PORT = int(TOR_CONFIG.get("ControlPort"))
-        with stem.control.Controller.from_port(port=CONTROL_PORT) as controller:
-            controller.authenticate()
-            controller.signal(stem.Signal.NEWNYM)
+        self.get_controller().signal(stem.Signal.NEWNYM)
 
     def stop(self) -> None:
         """
-        Stops the Tor process if running.
+        Stops the Tor process if running (a bootstrap in progress is stopped when finished).
         """
+        self.stopped = True
+        with self.controller_lock:
+            if self.controller is not None:
+                self.controller.close()
+                self.controller = None
         if self.tor_process:
-            self.tor_process.kill()
+            # terminated gracefully, so that Tor saves its state into the data directory
+            self.tor_process.terminate()
+            try:
+                self.tor_process.wait(TOR_STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.tor_process.kill()
+        if self.data_dir_lock is not None:
+            self.data_dir_lock.close()
+            self.data_dir_lock = None
+        # ports of a starting process are released by the bootstrap when finished
+        if self.lock.acquire(blocking=False):
+            try:
+                _release_ports(self.sock_port, self.control_port)
+                (self.sock_port, self.control_port) = (None, None)
+            finally:
+                self.lock.release()
+
+
+class TorPool:
+    """
+    Several Tor processes (each with its own ports and data directory) used by link-acquisition
+    workers, so that links are obtained over independent Tor instances in parallel.
+
+    The first instance is the main one (used also outside of the workers, e.g. for pages with
+    enforced Tor), the other ones are started when used for the first time and copy directory
+    data of the main instance when they have none, so they bootstrap warm.
+    """
+    runners: List[TorRunner]
+
+    # Condition and protected variables
+    cond: threading.Condition
+    free: List[TorRunner]
+
+    def __init__(self, size: int, temp_dir: str, log_func: Callable) -> None:
+        """
+        Args:
+            size (int): number of Tor instances.
+            temp_dir (str): the directory where data directories of instances are stored.
+            log_func (Callable): a function that will be called to log messages.
+        """
+        self.runners = [TorRunner(temp_dir, log_func) for _ in range(max(1, size))]
+        reputation = ExitReputation(path.join(temp_dir, EXIT_REPUTATION_FILE))
+        for tor in self.runners:
+            tor.reputation = reputation
+        self.cond = threading.Condition()
+        self.free = list(self.runners)
+
+    @property
+    def main(self) -> TorRunner:
+        return self.runners[0]
+
+    def __len__(self) -> int:
+        return len(self.runners)
+
+    def launch_background(self) -> None:
+        """
+        Starts the main instance in the background (see TorRunner.launch_background).
+        """
+        self.main.launch_background()
+
+    @contextmanager
+    def lease(self) -> Iterator[TorRunner]:
+        """
+        Exclusive use of a launched Tor instance (waits for a free one), the main instance is preferred.
+        """
+        with self.cond:
+            while not self.free:
+                self.cond.wait()
+            tor = self.free.pop(0)
+        try:
+            self._launch(tor)
+            yield tor
+        finally:
+            with self.cond:
+                self.free.append(tor)
+                self.free.sort(key=self.runners.index)
+                self.cond.notify()
+
+    def get(self, index: int) -> TorRunner:
+        """
+        Shared use of a launched Tor instance by the link worker of given index (workers are spread over instances).
+        """
+        tor = self.runners[index % len(self.runners)]
+        self._launch(tor)
+        return tor
+
+    def _launch(self, tor: TorRunner) -> None:
+        if tor is not self.main:
+            tor.seed_dir = self.main.data_dir
+        tor.launch()
+
+    def stop(self) -> None:
+        """
+        Stops all Tor processes.
+        """
+        for tor in self.runners:
+            tor.stop()
@@ -1,3 +1,5 @@
+import os
+import random
 import socket
 from enum import Enum
 from typing import List
@@ -50,3 +52,37 @@ class DownloaderStopped(Exception):
 
 class DownloaderError(Exception):
     pass
+
+
+class PartError(Exception):
+    """Recoverable failure of a part download (retried from the written offset)"""
+    link_failed: bool
+
+    def __init__(self, msg: str, link_failed: bool = False):
+        """
+        Arguments:
+            link_failed: the download link seems to be expired or blocked, a new one is needed
+        """
+        super().__init__(msg)
+        self.link_failed = link_failed
+
+
+def backoff_delay(attempt: int, base: float, maximum: float) -> float:
+    """Exponential backoff with jitter: random delay between the half and the whole of base * 2^(attempt-1)"""
+    delay = min(base * 2 ** (attempt - 1), maximum)
+    return random.uniform(delay / 2, delay)
+
+
+def try_lock_file(f) -> bool:
+    """Lock the open file exclusively without waiting, the lock is released when the file is closed
+    (also when the process dies). Returns False when locked by another process."""
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False